@@ -1,7 +1,9 @@
 from django.contrib import admin
 
-from .models import Course, Lesson, Access
+from .models import Course, Lesson, Access, Job, VideoBlob
 # Register your models here.
 admin.site.register(Course)
 admin.site.register(Lesson)
 admin.site.register(Access)
+admin.site.register(Job)
+admin.site.register(VideoBlob)
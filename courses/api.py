@@ -1,30 +1,185 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+
 import requests
 
+from . import profiling
+
+
+UNAVAILABLE = (503, {'detail': 'Users service unavailable'})
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if (self._state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                # let exactly one trial call through
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._state == self.HALF_OPEN
+                    or self._failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            retry_in = 0.0
+            if state == self.OPEN:
+                retry_in = max(0.0, self.reset_timeout -
+                               (time.monotonic() - self._opened_at))
+            return {
+                'state': state,
+                'failures': self._failures,
+                'retry_in': round(retry_in, 3),
+            }
+
+
+class RetryBudget:
+    """Token bucket limiting retries to a fraction of regular calls."""
+
+    def __init__(self, ratio: float = 0.2, cap: float = 10):
+        self.ratio = ratio
+        self.cap = cap
+        self._tokens = cap
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.cap, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            return self._tokens
+
 
 class API:
     URLS = {
         'users': 'http://kong:8000/users'
     }
+    # (connect, read) timeout of a single attempt, in seconds
+    TIMEOUT = (1, 3)
+    # total time a call may take, retries included
+    DEADLINE = 5
+    RETRIES = 2
+    BACKOFF = 0.1
+
+    breaker = CircuitBreaker()
+    retry_budget = RetryBudget()
 
     def headers(self, token: str):
         return {
             'Authorization': f'Bearer {token}'
         }
 
+    def _request(self, method: str, url: str, retry: bool = True, **kwargs):
+        if not self.breaker.allow():
+            return UNAVAILABLE
+        self.retry_budget.deposit()
+        deadline = time.monotonic() + self.DEADLINE
+        attempt = 0
+
+        while True:
+            remaining = max(deadline - time.monotonic(), 0.01)
+            start = time.perf_counter()
+            status = None
+            try:
+                response = requests.request(
+                    method, url,
+                    timeout=(min(self.TIMEOUT[0], remaining),
+                             min(self.TIMEOUT[1], remaining)),
+                    **kwargs
+                )
+                status = response.status_code
+                if response.status_code < 500:
+                    # a body that is not JSON, e.g. an error page of the
+                    # gateway, fails the attempt and is retried like a 5xx
+                    data = response.json()
+                    self.breaker.record_success()
+                    return response.status_code, data
+            except requests.RequestException:
+                pass
+            except Exception:
+                # a trial call must always settle the breaker
+                self.breaker.record_failure()
+                raise
+            finally:
+                profiling.record_upstream(
+                    start, method=method, url=url, status=status,
+                    attempt=attempt)
+
+            attempt += 1
+            # full jitter keeps retrying callers from moving in lockstep
+            delay = random.uniform(0, self.BACKOFF * 2 ** attempt)
+            if (not retry or attempt > self.RETRIES
+                    or time.monotonic() + delay >= deadline
+                    or not self.retry_budget.withdraw()):
+                self.breaker.record_failure()
+                return UNAVAILABLE
+            time.sleep(delay)
+
     def get_user(self, user_id: int):
-        response = requests.get(
-            f'{self.URLS["users"]}/{user_id}',
-        )
-        return response.status_code, response.json()
+        return self._request('GET', f'{self.URLS["users"]}/{user_id}')
 
     def get_users(self, user_ids: list[int]):
-        response = requests.get(
+        return self._request(
+            'GET',
             f'{self.URLS["users"]}',
             params={
                 'ids': user_ids
             }
         )
-        return response.status_code, response.json()
 
     def create_user(
             self,
@@ -32,20 +187,22 @@ class API:
             password: str,
             is_instructor: bool = False
     ):
-        response = requests.post(
+        return self._request(
+            'POST',
             f'{self.URLS["users"]}/register',
+            retry=False,
             json={'username': username, 'password': password,
                   'is_instructor': is_instructor
                   }
         )
-        return response.status_code, response.json()
 
     def login(self, username: str, password: str):
-        response = requests.post(
+        return self._request(
+            'POST',
             f'{self.URLS["users"]}/login',
+            retry=False,
             json={'username': username, 'password': password}
         )
-        return response.status_code, response.json()
 
     def login_or_register(
         self,
@@ -54,6 +211,210 @@ class API:
         instructor: bool = False
     ):
         status, response = self.login(username, password)
+        if status == UNAVAILABLE[0]:
+            return status, response
         if status != 200:
             return self.create_user(username, password, instructor)
         return status, response
+
+
+class _Batch:
+    def __init__(self, done):
+        self.done = done
+        self.ids = set()
+        self.status = None
+        self.data = None
+        self.users = {}
+        self.error = None
+        self.task = None
+
+    def resolve(self, status, data):
+        self.status, self.data = status, data
+        if status == 200:
+            self.users = {u['id']: u for u in data}
+
+    def result(self, user_id: int):
+        if self.error is not None:
+            raise self.error
+        if self.status != 200:
+            return self.status, self.data
+        if user_id in self.users:
+            return 200, self.users[user_id]
+        return 404, {'detail': 'Not Found'}
+
+
+class UserBatcher:
+    """Collapses concurrent user lookups into shared `get_users` calls.
+
+    A single-id lookup waits `window` seconds for other lookups to join
+    its batch; an id already being fetched is never requested twice.
+    """
+
+    def __init__(self, fetch, window: float = 0.005, max_size: int = 100):
+        self.fetch = fetch
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending = None
+        self._inflight = {}
+
+    def get(self, user_id: int):
+        leader = False
+        with self._lock:
+            batch = self._inflight.get(user_id)
+            if batch is None:
+                if self._pending is None or len(self._pending.ids) >= self.max_size:
+                    self._pending = _Batch(threading.Event())
+                    leader = True
+                batch = self._pending
+                batch.ids.add(user_id)
+                self._inflight[user_id] = batch
+        if leader:
+            time.sleep(self.window)
+            self._run(batch)
+        else:
+            batch.done.wait()
+        return batch.result(user_id)
+
+    def get_many(self, user_ids: list[int]):
+        ids = list(dict.fromkeys(user_ids))
+        batches = {}
+        own = None
+        with self._lock:
+            for user_id in ids:
+                batch = self._inflight.get(user_id)
+                if batch is None:
+                    if own is None:
+                        own = _Batch(threading.Event())
+                    own.ids.add(user_id)
+                    self._inflight[user_id] = own
+                    batch = own
+                batches[user_id] = batch
+        if own is not None:
+            self._run(own)
+        for batch in set(batches.values()):
+            batch.done.wait()
+        return _merge(ids, batches)
+
+    def _run(self, batch: _Batch):
+        with self._lock:
+            if self._pending is batch:
+                self._pending = None
+        try:
+            batch.resolve(*self.fetch(sorted(batch.ids)))
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                for user_id in batch.ids:
+                    if self._inflight.get(user_id) is batch:
+                        del self._inflight[user_id]
+            batch.done.set()
+
+
+class AsyncUserBatcher:
+    """asyncio counterpart of `UserBatcher`, bound to one event loop."""
+
+    def __init__(self, fetch, window: float = 0.005, max_size: int = 100):
+        self.fetch = fetch
+        self.window = window
+        self.max_size = max_size
+        self._pending = None
+        self._inflight = {}
+
+    async def get(self, user_id: int):
+        batch = self._inflight.get(user_id)
+        if batch is None:
+            if self._pending is None or len(self._pending.ids) >= self.max_size:
+                self._pending = _Batch(asyncio.Event())
+                # the batch runs in its own task, a cancelled caller
+                # cannot leave the others waiting for it
+                self._pending.task = asyncio.create_task(
+                    self._run(self._pending, self.window))
+            batch = self._pending
+            batch.ids.add(user_id)
+            self._inflight[user_id] = batch
+        await batch.done.wait()
+        return batch.result(user_id)
+
+    async def get_many(self, user_ids: list[int]):
+        ids = list(dict.fromkeys(user_ids))
+        batches = {}
+        own = None
+        for user_id in ids:
+            batch = self._inflight.get(user_id)
+            if batch is None:
+                if own is None:
+                    own = _Batch(asyncio.Event())
+                own.ids.add(user_id)
+                self._inflight[user_id] = own
+                batch = own
+            batches[user_id] = batch
+        if own is not None:
+            own.task = asyncio.create_task(self._run(own))
+        for batch in set(batches.values()):
+            await batch.done.wait()
+        return _merge(ids, batches)
+
+    async def _run(self, batch: _Batch, delay: float = 0):
+        try:
+            # lets other lookups join the batch
+            await asyncio.sleep(delay)
+            if self._pending is batch:
+                self._pending = None
+            batch.resolve(*await asyncio.to_thread(
+                self.fetch, sorted(batch.ids)))
+        except BaseException as e:
+            # waiters get an error even if the task itself was cancelled
+            batch.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if self._pending is batch:
+                self._pending = None
+            for user_id in batch.ids:
+                if self._inflight.get(user_id) is batch:
+                    del self._inflight[user_id]
+            batch.done.set()
+
+
+def _merge(ids: list[int], batches: dict):
+    users = []
+    for user_id in ids:
+        status, data = batches[user_id].result(user_id)
+        if status == 200:
+            users.append(data)
+        elif status != 404:
+            return status, data
+    return 200, users
+
+
+class CoalescingAPI(API):
+    """`API` whose user lookups go through shared batchers."""
+
+    def __init__(self, window: float = 0.005, max_size: int = 100):
+        self.batcher = UserBatcher(super().get_users, window, max_size)
+        self.window = window
+        self.max_size = max_size
+        self._async_batchers = weakref.WeakKeyDictionary()
+
+    def get_user(self, user_id: int):
+        return self.batcher.get(user_id)
+
+    def get_users(self, user_ids: list[int]):
+        return self.batcher.get_many(user_ids)
+
+    def async_batcher(self):
+        loop = asyncio.get_running_loop()
+        batcher = self._async_batchers.get(loop)
+        if batcher is None:
+            batcher = AsyncUserBatcher(
+                super().get_users, self.window, self.max_size)
+            self._async_batchers[loop] = batcher
+        return batcher
+
+    async def aget_user(self, user_id: int):
+        return await self.async_batcher().get(user_id)
+
+    async def aget_users(self, user_ids: list[int]):
+        return await self.async_batcher().get_many(user_ids)
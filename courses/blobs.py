@@ -0,0 +1,294 @@
+import hashlib
+import os
+import re
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import jobs
+from .models import Lesson, Upload, VideoBlob
+from .storage import video_storage
+
+
+CHUNK_SIZE = 1024 * 1024
+# a new blob no lesson uses by then is deleted
+UNUSED_BLOB_TTL = timedelta(hours=24)
+# an unfinished upload session nobody continued by then is deleted
+UPLOAD_TTL = timedelta(days=2)
+BLOB_KEY = re.compile(r'videos/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]{1,9})?')
+# where presigned uploads go until they are checked
+STAGED_KEY = re.compile(r'staged/([0-9a-f-]{36})(\.[a-z0-9]{1,9})?')
+
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset: int):
+        super().__init__(f"Upload continues at byte {offset}")
+        self.offset = offset
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def _extension(name: str) -> str:
+    ext = os.path.splitext(name)[1].lower()
+    return ext if re.fullmatch(r'\.[a-z0-9]{1,9}', ext) else ''
+
+
+def blob_name(sha256: str, name: str) -> str:
+    return f"videos/{sha256[:2]}/{sha256}{_extension(name)}"
+
+
+def owned_by(instructor_id: int):
+    """Blobs the instructor uploaded or already uses in own lessons.
+
+    A checksum is no proof of having the content, other blobs may only
+    be used after uploading them again.
+    """
+    return VideoBlob.objects.filter(
+        Exists(Upload.objects.filter(
+            blob=OuterRef('pk'), instructor_id=instructor_id))
+        | Exists(Lesson.objects.filter(
+            blob=OuterRef('pk'), course__instructor_id=instructor_id))
+    )
+
+
+def from_key(key: str, instructor_id: int) -> VideoBlob:
+    """Returns the blob for a video uploaded straight to the storage.
+
+    `key` is the one `presign` returned, either where the content was
+    uploaded to or the key of a blob the instructor already has.
+    """
+    match = BLOB_KEY.fullmatch(key)
+    if match:
+        blob = owned_by(instructor_id).filter(sha256=match[1]).first()
+        if blob is None:
+            raise ValueError("Video has not been uploaded")
+        return blob
+    match = STAGED_KEY.fullmatch(key)
+    if not match:
+        raise ValueError("Not a video key")
+
+    with transaction.atomic():
+        upload = Upload.objects.select_for_update().filter(
+            pk=match[1], instructor_id=instructor_id).first()
+        if upload is None:
+            raise ValueError("Video has not been uploaded")
+        if upload.blob_id is None:
+            storage = video_storage()
+            if not storage.exists(key):
+                raise ValueError("Video has not been uploaded")
+            # only the storage knows what was really uploaded
+            if (storage.size(key) != upload.size
+                    or storage.checksum(key) != upload.sha256):
+                storage.delete(key)
+                raise ValueError("Uploaded content does not match checksum")
+            upload.blob = _get_or_create(
+                upload.sha256, upload.size, upload.name, staged=key)
+            upload.offset = upload.size
+            upload.save(update_fields=['blob', 'offset', 'updated_at'])
+    return upload.blob
+
+
+def presign(instructor_id: int, sha256: str, size: int, name: str):
+    """Returns a presigned upload for the content, None if it is stored.
+
+    Content goes to a key of its own and only becomes a blob once
+    `from_key` checked it, whether or not the blob exists already.
+    """
+    if owned_by(instructor_id).filter(sha256=sha256).exists():
+        return None
+    upload = Upload.objects.create(
+        instructor_id=instructor_id, sha256=sha256, size=size, name=name)
+    _expire(upload)
+    key = staged_key(upload)
+    return key, video_storage().presigned_upload(key, sha256, size)
+
+
+def staged_key(upload: Upload) -> str:
+    return f"staged/{upload.pk}{_extension(upload.name)}"
+
+
+def _created(blob: VideoBlob) -> VideoBlob:
+    # purge_blob keeps it if a lesson got to use it in the meantime
+    jobs.enqueue('purge_blob', delay=UNUSED_BLOB_TTL, blob_id=blob.pk)
+    return blob
+
+
+def _get_or_create(
+    sha256: str, size: int, name: str, content=None, staged: str | None = None
+) -> VideoBlob:
+    """Stores `content`, or moves the `staged` one, unless it exists."""
+    storage = video_storage()
+    blob = VideoBlob.objects.filter(sha256=sha256).first()
+    if blob:
+        if staged:
+            storage.delete(staged)
+        return blob
+    if staged:
+        stored = storage.move(staged, blob_name(sha256, name))
+    else:
+        stored = storage.save(blob_name(sha256, name), content)
+    try:
+        with transaction.atomic():
+            return _created(VideoBlob.objects.create(
+                sha256=sha256, size=size, file=stored
+            ))
+    except IntegrityError:
+        # somebody stored the same content at the same time
+        storage.delete(stored)
+        return VideoBlob.objects.get(sha256=sha256)
+
+
+def store(f) -> VideoBlob:
+    """Stores an uploaded file unless identical content already exists."""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in f.chunks(CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    f.seek(0)
+    return _get_or_create(digest.hexdigest(), size, f.name, f)
+
+
+def attach(lesson: Lesson, blob: VideoBlob) -> None:
+    """Points the lesson video at the blob, without saving the lesson."""
+    old_id = lesson.blob_id
+    if old_id == blob.pk:
+        return
+    if not VideoBlob.objects.filter(pk=blob.pk).update(
+            ref_count=F('ref_count') + 1):
+        raise VideoBlob.DoesNotExist
+    lesson.blob = blob
+    lesson.video.name = blob.file.name
+    if old_id:
+        release(old_id)
+
+
+def release(blob_id: int) -> None:
+    jobs.release_blobs({blob_id: 1})
+
+
+@receiver(post_delete, sender=Lesson)
+def release_lesson_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        release(instance.blob_id)
+
+
+def part_path(upload: Upload) -> Path:
+    directory = settings.UPLOAD_DIR or Path(settings.MEDIA_ROOT) / 'uploads'
+    return Path(directory) / f"{upload.pk}.part"
+
+
+def start_upload(
+    instructor_id: int, sha256: str, size: int, name: str
+) -> tuple[Upload, bool]:
+    """Returns an upload session for the content and whether it is new.
+
+    Content the instructor already has completes the session right away
+    and an unfinished session for the same content is resumed.
+    """
+    blob = owned_by(instructor_id).filter(sha256=sha256, size=size).first()
+    upload = Upload.objects.filter(
+        instructor_id=instructor_id, sha256=sha256, size=size
+    ).order_by('-created_at').first()
+    if upload and (upload.blob_id
+                   or (not blob and upload.offset < upload.size)):
+        return upload, False
+    upload = Upload.objects.create(
+        instructor_id=instructor_id, sha256=sha256, size=size, name=name,
+        blob=blob, offset=size if blob else 0,
+    )
+    if not blob:
+        _expire(upload)
+    return upload, True
+
+
+def _expire(upload: Upload, delay: timedelta = UPLOAD_TTL) -> None:
+    jobs.enqueue('purge_upload', delay=delay, upload_id=str(upload.pk))
+
+
+@jobs.job('purge_upload')
+def purge_upload(upload_id: str):
+    """Deletes an upload session unless it finished or is still used."""
+    with transaction.atomic():
+        upload = Upload.objects.select_for_update().filter(
+            pk=upload_id, blob__isnull=True).first()
+        if upload is None:
+            return
+        expires = upload.updated_at + UPLOAD_TTL
+        if expires > timezone.now():
+            _expire(upload, expires - timezone.now())
+            return
+        path, key = part_path(upload), staged_key(upload)
+        upload.delete()
+    path.unlink(missing_ok=True)
+    video_storage().delete(key)
+
+
+def write_chunk(upload_id, instructor_id: int, offset: int, stream) -> Upload:
+    """Appends bytes read from `stream` to the upload at `offset`."""
+    with transaction.atomic():
+        upload = Upload.objects.select_for_update().get(
+            pk=upload_id, instructor_id=instructor_id)
+        if upload.blob_id:
+            return upload
+        path = part_path(upload)
+        written = path.stat().st_size if path.exists() else 0
+        if written < upload.offset:
+            # the part file is gone or cut short, e.g. after a restart,
+            # so the client has to resume from what is really there
+            upload.offset = written
+            upload.save(update_fields=['offset', 'updated_at'])
+        if offset != upload.offset:
+            error = OffsetMismatch(upload.offset)
+        else:
+            error = _append(upload, path, stream)
+    # raised after the transaction, which keeps the offset it reset
+    if error:
+        raise error
+    return upload
+
+
+def _append(upload: Upload, path: Path, stream) -> ChecksumMismatch | None:
+    offset = upload.offset
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'r+b' if path.exists() else 'wb') as f:
+        # drop leftovers of an interrupted write
+        f.truncate(offset)
+        f.seek(offset)
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            offset += len(chunk)
+            if offset > upload.size:
+                f.truncate(upload.offset)
+                raise ValueError("Upload is bigger than declared")
+            f.write(chunk)
+
+    error = None
+    upload.offset = offset
+    if offset == upload.size and not _complete(upload, path):
+        # start over, the content got corrupted on the way
+        upload.offset = 0
+        error = ChecksumMismatch("Uploaded content does not match checksum")
+    upload.save(update_fields=['offset', 'blob', 'updated_at'])
+    return error
+
+
+def _complete(upload: Upload, path: Path) -> bool:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if digest.hexdigest() == upload.sha256:
+        with open(path, 'rb') as f:
+            upload.blob = _get_or_create(
+                upload.sha256, upload.size, upload.name, File(f))
+    path.unlink()
+    return upload.blob_id is not None
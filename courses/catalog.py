@@ -0,0 +1,117 @@
+from django.core.cache import caches
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import schemas
+from .models import Course, Lesson
+
+
+# Snapshot of the public course list. Every course is kept serialized
+# under its own key, `ids` holds their order and assembled pages are
+# cached per snapshot version, so a change re-serializes one course only.
+TTL = 60 * 60
+PAGE_TTL = 60
+MAX_AGE = 30
+
+
+def _cache():
+    return caches[settings.CATALOG_CACHE]
+
+
+def _course_key(course_id: int) -> str:
+    return f"catalog:course:{course_id}"
+
+
+def _page_key(version: int, limit: int, offset: int) -> str:
+    return f"catalog:page:{version}:{limit}:{offset}"
+
+
+def _serialize(course: Course) -> bytes:
+    return schemas.CourseSchema.from_orm(course).model_dump_json().encode()
+
+
+def _courses():
+    return Course.objects.annotate(lesson_count=Count('lesson')).order_by('pk')
+
+
+def _bump_version(cache) -> None:
+    try:
+        cache.incr('catalog:version')
+    except ValueError:
+        cache.set('catalog:version', 1, None)
+
+
+def rebuild() -> tuple[list[int], dict[str, bytes]]:
+    cache = _cache()
+    courses = list(_courses())
+    ids = [c.pk for c in courses]
+    entries = {_course_key(c.pk): _serialize(c) for c in courses}
+    cache.set_many(entries, TTL)
+    cache.set('catalog:ids', ids, TTL)
+    _bump_version(cache)
+    return ids, entries
+
+
+def refresh(course_id: int) -> None:
+    """Re-serializes one course, or drops the index when it came or went.
+
+    The index is never written back here, concurrent refreshes could
+    overwrite each other's copy of it. Without it the next read rebuilds
+    the snapshot.
+    """
+    cache = _cache()
+    ids = cache.get('catalog:ids')
+    if ids is None:
+        # nothing to update, the next read rebuilds everything
+        return
+    course = _courses().filter(pk=course_id).first()
+    if course and course_id in ids:
+        cache.set(_course_key(course_id), _serialize(course), TTL)
+    else:
+        cache.delete_many([_course_key(course_id), 'catalog:ids'])
+    _bump_version(cache)
+
+
+def refresh_on_commit(course_id: int) -> None:
+    transaction.on_commit(lambda: refresh(course_id))
+
+
+def page(limit: int, offset: int) -> tuple[bytes, int]:
+    """Returns the page as JSON and the snapshot version it came from."""
+    cache = _cache()
+    version = cache.get('catalog:version', 0)
+    key = _page_key(version, limit, offset)
+    content = cache.get(key)
+    if content is not None:
+        return content, version
+
+    ids = cache.get('catalog:ids')
+    items = {}
+    if ids is not None:
+        keys = [_course_key(i) for i in ids[offset:offset + limit]]
+        items = cache.get_many(keys)
+    # some entries may have expired before the index did
+    if ids is None or len(items) != len(keys):
+        ids, items = rebuild()
+        keys = [_course_key(i) for i in ids[offset:offset + limit]]
+        version = cache.get('catalog:version', 0)
+        key = _page_key(version, limit, offset)
+    content = b'{"items":[%s],"count":%d}' % (
+        b','.join(items[k] for k in keys), len(ids))
+    cache.set(key, content, PAGE_TTL)
+    return content, version
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+def course_changed(sender, instance, **kwargs):
+    refresh_on_commit(instance.pk)
+
+
+@receiver(post_save, sender=Lesson)
+@receiver(post_delete, sender=Lesson)
+def lesson_changed(sender, instance, **kwargs):
+    refresh_on_commit(instance.course_id)
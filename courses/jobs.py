@@ -0,0 +1,313 @@
+import hashlib
+from collections import Counter, defaultdict
+import json
+import shutil
+import subprocess
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import (
+    Access, Course, Job, JoinRequest, Lesson, VideoBlob, VideoStatus
+)
+
+
+# name -> (function, maximum number of jobs of that kind running at once)
+REGISTRY = {}
+# a running job that has not finished after this long is considered lost
+LOCK_TIMEOUT = timedelta(minutes=30)
+BACKOFF = 10
+# rows removed per statement when purging a deleted course
+PURGE_BATCH = 1000
+
+
+def job(name: str, concurrency: int | None = None):
+    def register(func):
+        REGISTRY[name] = (func, concurrency)
+        return func
+    return register
+
+
+def enqueue(
+    name: str,
+    max_attempts: int = 3,
+    delay: timedelta | None = None,
+    **payload,
+) -> None:
+    """Queues a job once the current transaction commits."""
+    def create():
+        Job.objects.create(
+            name=name, payload=payload, max_attempts=max_attempts,
+            run_at=timezone.now() + (delay or timedelta()),
+        )
+    transaction.on_commit(create)
+
+
+def _lock_kind(name: str) -> None:
+    """Serializes claims of one job kind until the transaction ends."""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                [f'courses.jobs:{name}'])
+    # advisory locks exist on PostgreSQL only, which is what the project
+    # runs on; elsewhere per-kind limits are not safe across workers
+
+
+def _free_slots() -> dict[str, int]:
+    """Returns how many more jobs of each limited kind may start."""
+    limits = {
+        name: concurrency
+        for name, (func, concurrency) in REGISTRY.items()
+        if concurrency is not None
+    }
+    # locked in a fixed order, so that concurrent claims cannot deadlock
+    for name in sorted(limits):
+        _lock_kind(name)
+    running = dict(
+        Job.objects.filter(status=Job.Status.RUNNING, name__in=limits)
+        .order_by().values_list('name').annotate(n=Count('id'))
+    )
+    return {
+        name: max(0, concurrency - running.get(name, 0))
+        for name, concurrency in limits.items()
+    }
+
+
+def claim(worker: str, limit: int = 1) -> list[Job]:
+    now = timezone.now()
+    Job.objects.filter(
+        status=Job.Status.RUNNING, locked_at__lt=now - LOCK_TIMEOUT
+    ).update(status=Job.Status.PENDING, locked_at=None, locked_by=None)
+
+    with transaction.atomic():
+        slots = _free_slots()
+        pending = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status=Job.Status.PENDING, run_at__lte=now)
+            .order_by('run_at')
+        )
+        unlimited = [name for name in REGISTRY if name not in slots]
+        jobs = list(pending.filter(name__in=unlimited)[:limit])
+        for name, free in slots.items():
+            if free:
+                jobs += pending.filter(name=name)[:min(free, limit)]
+        jobs = sorted(jobs, key=lambda j: j.run_at)[:limit]
+        Job.objects.filter(pk__in=[j.pk for j in jobs]).update(
+            status=Job.Status.RUNNING, locked_at=now, locked_by=worker
+        )
+    return jobs
+
+
+def run_job(obj: Job) -> None:
+    func, _ = REGISTRY[obj.name]
+    obj.attempts += 1
+    try:
+        func(**obj.payload)
+    except Exception:
+        obj.last_error = traceback.format_exc()
+        if obj.attempts >= obj.max_attempts:
+            obj.status = Job.Status.FAILED
+            on_failure = getattr(func, 'on_failure', None)
+            if on_failure:
+                on_failure(**obj.payload)
+        else:
+            obj.status = Job.Status.PENDING
+            obj.run_at = timezone.now() + timedelta(
+                seconds=BACKOFF * 2 ** (obj.attempts - 1))
+    else:
+        obj.status = Job.Status.DONE
+    obj.locked_at = obj.locked_by = None
+    obj.save(update_fields=['attempts', 'last_error', 'status', 'run_at',
+                            'locked_at', 'locked_by'])
+
+
+def _run_in_thread(obj: Job) -> None:
+    close_old_connections()
+    try:
+        run_job(obj)
+    finally:
+        close_old_connections()
+
+
+def run_worker(
+    worker: str,
+    concurrency: int = 2,
+    poll_interval: float = 1,
+    once: bool = False,
+    stop: threading.Event | None = None,
+) -> int:
+    """Runs queued jobs, at most `concurrency` at a time.
+
+    Returns the number of processed jobs.
+    """
+    stop = stop or threading.Event()
+    processed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        running = set()
+        while not stop.is_set():
+            running = {f for f in running if not f.done()}
+            free = concurrency - len(running)
+            jobs = claim(worker, free) if free else []
+            for obj in jobs:
+                running.add(pool.submit(_run_in_thread, obj))
+            processed += len(jobs)
+            if once and not jobs:
+                break
+            if not jobs:
+                time.sleep(poll_interval)
+            elif not free:
+                time.sleep(poll_interval / 10)
+    return processed
+
+
+def _probe_duration(path: str) -> float | None:
+    if not shutil.which('ffprobe'):
+        return None
+    result = subprocess.run(
+        ['ffprobe', '-v', 'quiet', '-print_format', 'json',
+         '-show_format', path],
+        capture_output=True, timeout=60,
+    )
+    if result.returncode != 0:
+        return None
+    duration = json.loads(result.stdout).get('format', {}).get('duration')
+    return float(duration) if duration else None
+
+
+def _local_duration(lesson: Lesson) -> float | None:
+    try:
+        return _probe_duration(lesson.video.path)
+    except NotImplementedError:
+        # storage without local paths
+        return None
+
+
+@job('process_lesson_video', concurrency=4)
+def process_lesson_video(lesson_id: int, video: str):
+    # clones share the stored file and may outlive the lesson that asked
+    lessons = Lesson.objects.filter(video=video)
+    lesson = lessons.filter(pk=lesson_id).first() or lessons.first()
+    if lesson is None:
+        # no lesson uses the file anymore
+        return
+    lessons.filter(video_status=VideoStatus.PENDING).update(
+        video_status=VideoStatus.PROCESSING)
+
+    done = lessons.filter(video_status=VideoStatus.READY).first()
+    if done:
+        # same stored file was already processed for another lesson
+        checksum, size = done.video_checksum, done.video_size
+        duration = done.video_duration
+    elif lesson.blob:
+        checksum, size = lesson.blob.sha256, lesson.blob.size
+        duration = _local_duration(lesson)
+    else:
+        digest = hashlib.sha256()
+        size = 0
+        with lesson.video.open('rb') as f:
+            for chunk in f.chunks():
+                digest.update(chunk)
+                size += len(chunk)
+        checksum = digest.hexdigest()
+        duration = _local_duration(lesson)
+
+    lessons.exclude(video_status=VideoStatus.READY).update(
+        video_status=VideoStatus.READY,
+        video_checksum=checksum,
+        video_size=size,
+        video_duration=duration,
+    )
+
+
+def _video_failed(lesson_id: int, video: str):
+    Lesson.objects.filter(
+        video=video,
+        video_status__in=[VideoStatus.PENDING, VideoStatus.PROCESSING],
+    ).update(video_status=VideoStatus.FAILED)
+
+
+process_lesson_video.on_failure = _video_failed
+
+
+@job('purge_blob')
+def purge_blob(blob_id: int):
+    with transaction.atomic():
+        blob = VideoBlob.objects.select_for_update().filter(
+            pk=blob_id, ref_count=0).first()
+        if blob is None or Lesson.objects.filter(blob=blob).exists():
+            return
+        name = blob.file.name
+        blob.delete()
+    blob.file.storage.delete(name)
+
+
+def release_blobs(counts: dict[int, int]) -> None:
+    """Drops `counts[blob_id]` references from each blob."""
+    by_count = defaultdict(list)
+    for blob_id, n in counts.items():
+        by_count[n].append(blob_id)
+    for n, ids in by_count.items():
+        VideoBlob.objects.filter(pk__in=ids).update(
+            ref_count=F('ref_count') - n)
+    for blob_id in VideoBlob.objects.filter(
+            pk__in=counts.keys(), ref_count=0).values_list('pk', flat=True):
+        enqueue('purge_blob', blob_id=blob_id)
+
+
+def _delete_in_batches(qs) -> None:
+    qs = qs.order_by()
+    while True:
+        ids = list(qs.values_list('pk', flat=True)[:PURGE_BATCH])
+        if not ids:
+            return
+        qs.model.objects.filter(pk__in=ids).delete()
+
+
+def _delete_rows(model, ids: list[int]) -> None:
+    """Deletes the rows with one DELETE, sending no signals."""
+    qn = connection.ops.quote_name
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {qn(model._meta.db_table)} "
+            f"WHERE {qn(model._meta.pk.column)} IN ({placeholders})",
+            ids
+        )
+
+
+def _purge_lessons(course_id: int) -> None:
+    qs = Lesson.objects.filter(course_id=course_id).order_by()
+    while True:
+        with transaction.atomic():
+            rows = list(qs.values_list('pk', 'blob_id', 'video')[:PURGE_BATCH])
+            if not rows:
+                return
+            # skip the collector and per-row signals, blob references
+            # are released below in bulk
+            _delete_rows(Lesson, [r[0] for r in rows])
+            release_blobs(Counter(blob for _, blob, _ in rows if blob))
+
+        # files uploaded before blobs existed, unless shared by a clone
+        files = {video for _, blob, video in rows if video and not blob}
+        used = set(Lesson.objects.filter(video__in=files)
+                   .values_list('video', flat=True))
+        for name in files - used:
+            Lesson.video.field.storage.delete(name)
+
+
+@job('purge_course', concurrency=2)
+def purge_course(course_id: int):
+    if not Course.all_objects.filter(
+            pk=course_id, deleted_at__isnull=False).exists():
+        return
+    _delete_in_batches(JoinRequest.objects.filter(course_id=course_id))
+    _delete_in_batches(Access.objects.filter(course_id=course_id))
+    _purge_lessons(course_id)
+    Course.all_objects.filter(pk=course_id).delete()
@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+
+FILES_MIDDLEWARE = 'ninja.compatibility.files.fix_request_files_middleware'
+
+
+class Command(BaseCommand):
+    help = "Compares per-request cost of the full and the API middleware stacks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help="Rounds per stack, the fastest one is reported",
+        )
+        parser.add_argument(
+            '--path', default='/health/users',
+            help="Path requested through both stacks",
+        )
+
+    def measure(self, middleware: list[str], path: str, n: int,
+                repeat: int) -> float:
+        with override_settings(MIDDLEWARE=middleware):
+            client = Client()
+            for _ in range(min(n, 100)):
+                client.get(path)
+            rounds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in range(n):
+                    client.get(path)
+                rounds.append((time.perf_counter() - start) / n * 1e6)
+            return min(rounds)
+
+    def handle(self, *args, **options):
+        n, path = options['requests'], options['path']
+        repeat = options['repeat']
+        full = self.measure(
+            settings.FULL_MIDDLEWARE + [FILES_MIDDLEWARE], path, n, repeat)
+        lean = self.measure(
+            ['main.middleware.PathMiddleware', FILES_MIDDLEWARE], path, n,
+            repeat)
+        self.stdout.write(f"GET {path}, {n} requests")
+        self.stdout.write(f"full stack: {full:8.1f} us/request")
+        self.stdout.write(f"API stack:  {lean:8.1f} us/request")
+        self.stdout.write(
+            f"saved:      {full - lean:8.1f} us/request "
+            f"({(full - lean) / full:.0%})"
+        )
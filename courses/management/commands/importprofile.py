@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+SCRIPT = "import django; django.setup(); import main.urls"
+
+
+class Command(BaseCommand):
+    help = "Profiles module import time of a cold service start"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20)
+
+    def handle(self, *args, **options):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', SCRIPT],
+            capture_output=True, text=True, cwd=settings.BASE_DIR,
+            env=os.environ.copy(),
+        )
+        if result.returncode != 0:
+            self.stderr.write(result.stderr)
+            return
+
+        rows = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or '[us]' in line:
+                continue
+            self_us, cumulative, name = line[len('import time:'):].split('|')
+            rows.append((int(cumulative), int(self_us), name.rstrip()))
+
+        total = sum(self_us for _, self_us, _ in rows)
+        self.stdout.write(
+            f"{len(rows)} modules imported in {total / 1000:.1f} ms")
+        self.stdout.write(f"{'cumulative ms':>14} {'self ms':>8}  module")
+        for cumulative, self_us, name in sorted(rows, reverse=True)[:options['top']]:
+            self.stdout.write(
+                f"{cumulative / 1000:14.1f} {self_us / 1000:8.1f}  {name}")
@@ -0,0 +1,73 @@
+import io
+import json
+import pstats
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Summarizes request profiles written by ProfilingMiddleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.PROFILING_DIR)
+        parser.add_argument('--top', type=int, default=25)
+        parser.add_argument(
+            '--sort', default='tottime',
+            choices=['tottime', 'cumulative', 'ncalls'],
+        )
+        parser.add_argument(
+            '--path', default=None,
+            help="Only include requests whose path contains this text",
+        )
+
+    def handle(self, *args, **options):
+        directory = Path(options['dir'])
+        timelines = []
+        for file in sorted(directory.glob('*.json')):
+            timeline = json.loads(file.read_text())
+            if options['path'] and options['path'] not in timeline['path']:
+                continue
+            timelines.append((file, timeline))
+        if not timelines:
+            self.stdout.write(f"No profiles in {directory}")
+            return
+
+        self.timelines([t for _, t in timelines])
+        profiles = [
+            str(f.with_suffix('.prof')) for f, _ in timelines
+            if f.with_suffix('.prof').exists()
+        ]
+        if profiles:
+            self.stdout.write(f"\nHottest frames of {len(profiles)} profile(s)")
+            out = io.StringIO()
+            stats = pstats.Stats(*profiles, stream=out)
+            stats.strip_dirs().sort_stats(options['sort'])
+            stats.print_stats(options['top'])
+            self.stdout.write(out.getvalue())
+
+    def timelines(self, timelines: list[dict]):
+        by_path = defaultdict(list)
+        for t in timelines:
+            by_path[f"{t['method']} {t['path']}"].append(t)
+
+        self.stdout.write(
+            f"{'requests':>8} {'avg ms':>8} {'sql':>5} {'sql ms':>8} "
+            f"{'users':>5} {'users ms':>8}  endpoint"
+        )
+        for endpoint, items in sorted(
+                by_path.items(), key=lambda i: -sum(t['duration'] for t in i[1])):
+            n = len(items)
+            duration = sum(t['duration'] for t in items) / n
+            queries = sum(len(t['queries']) for t in items) / n
+            sql = sum(q['duration'] for t in items for q in t['queries']) / n
+            calls = sum(len(t['upstream']) for t in items) / n
+            upstream = sum(
+                c['duration'] for t in items for c in t['upstream']) / n
+            self.stdout.write(
+                f"{n:8} {duration * 1000:8.1f} {queries:5.1f} "
+                f"{sql * 1000:8.1f} {calls:5.1f} {upstream * 1000:8.1f}  "
+                f"{endpoint}"
+            )
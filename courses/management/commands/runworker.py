@@ -0,0 +1,38 @@
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+
+from courses import jobs
+
+
+class Command(BaseCommand):
+    help = "Processes background jobs queued by the API"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=2,
+            help="Maximum number of jobs processed at once",
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Exit once the queue is empty",
+        )
+
+    def handle(self, *args, **options):
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.stdout.write(f"Worker {worker} started")
+        try:
+            processed = jobs.run_worker(
+                worker,
+                concurrency=options['concurrency'],
+                poll_interval=options['poll_interval'],
+                once=options['once'],
+            )
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(f"Processed {processed} job(s)")
@@ -0,0 +1,68 @@
+import hmac
+import random
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+
+from .profiling import Profile, prune
+
+
+class ProfilingMiddleware:
+    """Profiles sampled requests and ones sent with the profiling token.
+
+    A request is profiled when its `X-Profile` header matches
+    `PROFILING_TOKEN` or, otherwise, with `PROFILING_SAMPLE_RATE`
+    probability. The CPU profile and the timeline of SQL queries and
+    users service calls are written to `PROFILING_DIR`, which keeps the
+    dumps of the last `PROFILING_MAX_DUMPS` requests. Streamed responses
+    are profiled until their content is consumed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.token = settings.PROFILING_TOKEN
+        self.rate = settings.PROFILING_SAMPLE_RATE
+        self.directory = Path(settings.PROFILING_DIR)
+        self.max_dumps = settings.PROFILING_MAX_DUMPS
+
+    def wanted(self, request) -> bool:
+        header = request.headers.get('X-Profile')
+        if header and self.token and hmac.compare_digest(header, self.token):
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def __call__(self, request):
+        if not self.wanted(request):
+            return self.get_response(request)
+
+        profile = Profile(request.method, request.path)
+        with profile, connection.execute_wrapper(profile.sql_wrapper):
+            response = self.get_response(request)
+        response['X-Profile-Id'] = profile.name
+        profile.streamed = response.streaming
+        if response.streaming and not response.is_async:
+            response.streaming_content = self.stream(
+                profile, response.streaming_content, response.status_code)
+        else:
+            self.dump(profile, response.status_code)
+        return response
+
+    def dump(self, profile: Profile, status: int) -> None:
+        profile.dump(self.directory, status)
+        if self.max_dumps:
+            prune(self.directory, self.max_dumps)
+
+    def stream(self, profile: Profile, content, status: int):
+        # the profile is entered per chunk, nothing stays active while
+        # the server sends a chunk or when the client goes away
+        content = iter(content)
+        try:
+            while True:
+                with profile, connection.execute_wrapper(profile.sql_wrapper):
+                    chunk = next(content, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.dump(profile, status)
@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-19 11:30
+
+import courses.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0007_course_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='lesson',
+            name='video',
+            field=models.FileField(blank=True, null=True, storage=courses.storage.video_storage, upload_to='', verbose_name='lesson-videos/'),
+        ),
+        migrations.AlterField(
+            model_name='videoblob',
+            name='file',
+            field=models.FileField(max_length=200, storage=courses.storage.video_storage, upload_to=''),
+        ),
+    ]
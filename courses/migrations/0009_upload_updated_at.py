@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0008_video_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
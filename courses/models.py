@@ -1,12 +1,22 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.utils import timezone
 from django.core.validators import MinValueValidator
 import string
+import uuid
 import random
 
+from .storage import video_storage
+
 
 CODE_LENGTH = 10
 
 
+class ActiveCourseManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Course(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(null=True, blank=True)
@@ -14,6 +24,11 @@ class Course(models.Model):
         validators=[MinValueValidator(1)]
     )
     code = models.CharField(max_length=CODE_LENGTH, unique=True, null=True)
+    # set when the course is deleted, rows are purged in the background
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ActiveCourseManager()
+    all_objects = models.Manager()
 
     def __str__(self):
         return self.name
@@ -23,6 +38,24 @@ class Course(models.Model):
             self.code = self._generate_code()
         super().save(*args, **kwargs)
 
+    def clone(self, name: str | None = None) -> 'Course':
+        """Copies the course and its lessons, sharing lesson videos."""
+        with transaction.atomic():
+            course = Course.objects.create(
+                name=name or self.name,
+                description=self.description,
+                instructor_id=self.instructor_id,
+            )
+            course.lesson_count = Lesson.copy_between(self, course)
+            VideoBlob.objects.filter(
+                pk__in=Lesson.objects.filter(course=course).values('blob')
+            ).update(ref_count=F('ref_count') + Subquery(
+                Lesson.objects.filter(course=course, blob=OuterRef('pk'))
+                .order_by().values('blob').annotate(n=Count('pk'))
+                .values('n')
+            ))
+        return course
+
     def _generate_code(self):
         chars = string.ascii_uppercase + string.digits
         instructor_len = len(str(self.instructor_id))
@@ -35,7 +68,7 @@ class Course(models.Model):
                 k=CODE_LENGTH - instructor_len
             ))
             code = f"{self.instructor_id}{code}"
-            if not Course.objects.filter(code=code).exists():
+            if not Course.all_objects.filter(code=code).exists():
                 return code
 
 
@@ -53,6 +86,44 @@ class Access(models.Model):
         ]
 
 
+class VideoBlob(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveBigIntegerField()
+    file = models.FileField(max_length=200, storage=video_storage)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+
+class Upload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    instructor_id = models.PositiveBigIntegerField(
+        validators=[MinValueValidator(1)]
+    )
+    name = models.CharField(max_length=200)
+    sha256 = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    blob = models.ForeignKey(
+        VideoBlob, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.offset}/{self.size})"
+
+
+class VideoStatus(models.TextChoices):
+    NONE = 'none'
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+
+
 class Lesson(models.Model):
     name = models.CharField("Title", max_length=200)
     content = models.TextField()
@@ -60,7 +131,18 @@ class Lesson(models.Model):
         default=1,
         validators=[MinValueValidator(1)]
     )
-    video = models.FileField('lesson-videos/', null=True, blank=True)
+    video = models.FileField(
+        'lesson-videos/', null=True, blank=True, storage=video_storage
+    )
+    video_status = models.CharField(
+        max_length=10, choices=VideoStatus, default=VideoStatus.NONE
+    )
+    video_checksum = models.CharField(max_length=64, null=True, blank=True)
+    video_size = models.PositiveBigIntegerField(null=True, blank=True)
+    video_duration = models.FloatField(null=True, blank=True)
+    blob = models.ForeignKey(
+        VideoBlob, null=True, blank=True, on_delete=models.PROTECT
+    )
 
     course = models.ForeignKey(Course, on_delete=models.CASCADE)
     quiz_id = models.PositiveBigIntegerField(
@@ -70,6 +152,24 @@ class Lesson(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def copy_between(cls, source: Course, target: Course) -> int:
+        """Copies all lessons of `source` into `target` with one INSERT."""
+        qn = connection.ops.quote_name
+        course = cls._meta.get_field('course').column
+        columns = ', '.join(
+            qn(f.column) for f in cls._meta.concrete_fields
+            if not f.primary_key and f.column != course
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {qn(cls._meta.db_table)} ({columns}, {qn(course)}) "
+                f"SELECT {columns}, %s FROM {qn(cls._meta.db_table)} "
+                f"WHERE {qn(course)} = %s",
+                [target.pk, source.pk]
+            )
+            return cursor.rowcount
+
     class Meta:
         ordering = ['number']
 
@@ -79,3 +179,33 @@ class JoinRequest(models.Model):
         validators=[MinValueValidator(1)]
     )
     course = models.ForeignKey(Course, on_delete=models.CASCADE)
+
+
+class Job(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=10, choices=Status, default=Status.PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+    class Meta:
+        ordering = ['run_at']
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_queue_idx'),
+        ]
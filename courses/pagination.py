@@ -0,0 +1,19 @@
+from ninja.pagination import LimitOffsetPagination
+
+
+class EnrichedPagination(LimitOffsetPagination):
+    """Limit/offset pagination calling `enrich(items)` on each page.
+
+    Lets a view add data from other services to the page only, instead
+    of to every row of the queryset.
+    """
+
+    def __init__(self, enrich=None, **kwargs):
+        self.enrich = enrich
+        super().__init__(**kwargs)
+
+    def paginate_queryset(self, queryset, pagination, **params):
+        page = super().paginate_queryset(queryset, pagination, **params)
+        if self.enrich:
+            page['items'] = self.enrich(list(page['items']))
+        return page
@@ -0,0 +1,101 @@
+import cProfile
+import json
+import re
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+
+
+# profile of the request being handled, if it is profiled
+current = ContextVar('profile', default=None)
+# only one cProfile profiler can be active at once
+_profiler_lock = threading.Lock()
+
+
+class Profile:
+    """Profile of one request.
+
+    It can be entered more than once, e.g. for every chunk of a streamed
+    response, the CPU profile and the timeline then cover all of them.
+    """
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        slug = re.sub(r'[^a-zA-Z0-9]+', '-', path).strip('-') or 'root'
+        self.name = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{method}-{slug}"
+        self.queries = []
+        self.upstream = []
+        self.profiler = cProfile.Profile()
+        # whether any part of the request got CPU profiled
+        self.cpu = False
+        self.enabled = False
+        self.streamed = False
+        self.start = None
+        self.duration = 0.0
+
+    def __enter__(self):
+        self.token = current.set(self)
+        self.enabled = _profiler_lock.acquire(blocking=False)
+        if self.start is None:
+            self.start = time.perf_counter()
+        if self.enabled:
+            self.cpu = True
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.profiler.disable()
+            _profiler_lock.release()
+            self.enabled = False
+        self.duration = time.perf_counter() - self.start
+        current.reset(self.token)
+
+    def event(self, start: float, **data) -> dict:
+        return {
+            'start': round(start - self.start, 6),
+            'duration': round(time.perf_counter() - start, 6),
+            **data,
+        }
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(self.event(start, sql=sql))
+
+    def dump(self, directory: Path, status: int) -> str:
+        """Writes the profile and the timeline, returns their base name."""
+        directory.mkdir(parents=True, exist_ok=True)
+        if self.cpu:
+            self.profiler.dump_stats(directory / f"{self.name}.prof")
+        timeline = {
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'streamed': self.streamed,
+            'duration': round(self.duration, 6),
+            'queries': self.queries,
+            'upstream': self.upstream,
+        }
+        (directory / f"{self.name}.json").write_text(json.dumps(timeline))
+        return self.name
+
+
+def record_upstream(start: float, **data) -> None:
+    """Adds a call to another service to the profiled request timeline."""
+    profile = current.get()
+    if profile is not None:
+        profile.upstream.append(profile.event(start, **data))
+
+
+def prune(directory: Path, keep: int) -> None:
+    """Deletes the oldest dumps, so that those of `keep` requests remain."""
+    # names start with the time of the request
+    timelines = sorted(directory.glob('*.json'))
+    for timeline in timelines[:max(len(timelines) - keep, 0)]:
+        timeline.unlink(missing_ok=True)
+        timeline.with_suffix('.prof').unlink(missing_ok=True)
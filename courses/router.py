@@ -1,16 +1,44 @@
+from uuid import UUID
+
+from django.core import signing
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
-from ninja import Router, File, Form, Body
-from ninja.pagination import paginate
+from ninja import Router, File, Form, Body, Query
+from ninja.errors import HttpError
+from ninja.pagination import paginate, LimitOffsetPagination
 from ninja.files import UploadedFile
 
 from auth import AuthInstructor, AuthBearer
 
-from django.db.models import Count
-from . import models, schemas, api
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from . import models, schemas, api, jobs, blobs, streaming, pagination, catalog
+from .storage import video_storage, LocalVideoStorage
 
 
 router = Router(auth=AuthInstructor())
-api = api.API()
+api = api.CoalescingAPI()
+
+
+def _video_blob(request, video: UploadedFile | None, sha256: str | None, key: str | None = None):
+    if video:
+        return blobs.store(video)
+    if sha256:
+        return get_object_or_404(
+            blobs.owned_by(request.auth['id']), sha256=sha256)
+    if key:
+        try:
+            return blobs.from_key(key, request.auth['id'])
+        except ValueError as e:
+            raise HttpError(400, str(e))
+    return None
+
+
+def _process_video(lesson: models.Lesson):
+    jobs.enqueue('process_lesson_video',
+                 lesson_id=lesson.pk, video=lesson.video.name)
 
 
 @router.post("/", response={201: schemas.CourseSchemaWithCode})
@@ -21,10 +49,35 @@ def create_course(request, data: schemas.CourseSchemaIn):
     return 201, course
 
 
-@router.get("/", response=list[schemas.CourseSchema], auth=None)
-@paginate
-def list_courses(request):
-    return models.Course.objects.annotate(lesson_count=Count('lesson')).all()
+@router.get("/", response=schemas.CoursePage, auth=None)
+def list_courses(request, page: Query[LimitOffsetPagination.Input]):
+    content, version = catalog.page(page.limit, page.offset)
+    etag = f'"catalog-{version}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={catalog.MAX_AGE}'
+    return response
+
+
+def _count(model, **filters):
+    return Coalesce(Subquery(
+        model.objects.filter(course=OuterRef('pk'), **filters).order_by()
+        .values('course').annotate(n=Count('pk')).values('n')
+    ), 0)
+
+
+@router.get("/stats", response=list[schemas.CourseStatsSchema])
+def get_instructor_stats(request):
+    return models.Course.objects.filter(
+        instructor_id=request.auth['id']
+    ).annotate(
+        student_count=_count(models.Access),
+        pending_request_count=_count(models.JoinRequest),
+        lesson_count=_count(models.Lesson),
+    ).order_by('pk')
 
 
 @router.get("/{int:courseID}", response=schemas.CourseSchemaFull, auth=None)
@@ -37,27 +90,56 @@ def get_course(request, courseID: int):
     return obj
 
 
-@router.put("/{int:courseID}", response=schemas.CourseSchema)
-def update_course(request, courseID: int, body: schemas.CourseSchemaIn):
+def _save_changes(obj, data: dict, *extra: str) -> None:
+    """Sets the given fields and writes only the ones that changed."""
+    changed = [key for key, value in data.items() if getattr(obj, key) != value]
+    for key in changed:
+        setattr(obj, key, data[key])
+    if changed or extra:
+        obj.save(update_fields=changed + list(extra))
+
+
+def _update_course(request, courseID: int, data: dict):
     qs = models.Course.objects.filter(
         instructor_id=request.auth['id']).annotate(lesson_count=Count('lesson'))
     obj = get_object_or_404(qs, pk=courseID)
-    data = body.dict(exclude_unset=True)
-
-    for attr, value in data.items():
-        setattr(obj, attr, value)
-    obj.save()
+    _save_changes(obj, data)
     return obj
 
 
+@router.put("/{int:courseID}", response=schemas.CourseSchema)
+def update_course(request, courseID: int, body: schemas.CourseSchemaIn):
+    return _update_course(request, courseID, body.dict(exclude_unset=True))
+
+
+@router.patch("/{int:courseID}", response=schemas.CourseSchema)
+def patch_course(request, courseID: int, body: schemas.CourseSchemaPatch):
+    return _update_course(request, courseID, body.dict(exclude_unset=True))
+
+
 @router.delete("/{int:courseID}", response={204: None})
 def delete_course(request, courseID: int):
     qs = models.Course.objects.filter(instructor_id=request.auth['id'])
     obj = get_object_or_404(qs, pk=courseID)
-    obj.delete()
+    with transaction.atomic():
+        qs.filter(pk=obj.pk).update(deleted_at=timezone.now())
+        jobs.enqueue('purge_course', course_id=obj.pk)
+        catalog.refresh_on_commit(obj.pk)
     return 204, None
 
 
+@router.post("/{int:courseID}/clone", response={201: schemas.CourseSchemaWithCode})
+def clone_course(request, courseID: int, name: str | None = None):
+    qs = models.Course.objects.filter(instructor_id=request.auth['id'])
+    obj = get_object_or_404(qs, pk=courseID)
+    return 201, obj.clone(name)
+
+
+@router.get("/health/users", response=schemas.BreakerSchema, auth=None)
+def users_service_health(request):
+    return api.breaker.snapshot()
+
+
 @router.post("/join", response={200: dict}, auth=AuthBearer())
 def join_course(request, data: schemas.CodeSchema):
     obj = get_object_or_404(models.Course, code=data.code)
@@ -69,50 +151,166 @@ def join_course(request, data: schemas.CodeSchema):
         return 200, {'detail': "Success"}
 
 
-@router.post("/{int:courseID}/lessons", response={201: schemas.LessonSchemaFull})
+@router.post("/{int:courseID}/lessons", response={201: schemas.LessonSchemaFull, 400: dict})
 def create_lesson(request, courseID: int, data: Form[schemas.LessonSchemaIn], video: UploadedFile | None = File(None)):
     data = data.dict()
     data['course_id'] = courseID
     get_object_or_404(models.Course, pk=courseID)
+    blob = _video_blob(
+        request, video, data.pop('video_sha256'), data.pop('video_key'))
+
+    with transaction.atomic():
+        obj = models.Lesson(**data)
+        if blob:
+            blobs.attach(obj, blob)
+            obj.video_status = models.VideoStatus.PENDING
+        obj.save()
+        if blob:
+            _process_video(obj)
+    return 201, obj
 
-    if video:
-        data['video'] = video
 
-    obj = models.Lesson(**data)
-    obj.save()
-    return 201, obj
+@router.post("/uploads", response={200: schemas.UploadSchema, 201: schemas.UploadSchema})
+def start_upload(request, data: schemas.UploadSchemaIn):
+    upload, created = blobs.start_upload(
+        request.auth['id'], data.sha256, data.size, data.name)
+    return 201 if created else 200, upload
+
+
+@router.post("/uploads/presign", response=schemas.PresignSchema)
+def presign_upload(request, data: schemas.UploadSchemaIn):
+    presigned = blobs.presign(
+        request.auth['id'], data.sha256, data.size, data.name)
+    if presigned is None:
+        blob = models.VideoBlob.objects.get(sha256=data.sha256)
+        return {'key': blob.file.name, 'complete': True}
+    key, upload = presigned
+    return {
+        'key': key, 'complete': False, 'url': upload.url,
+        'method': upload.method, 'headers': upload.headers,
+        'expires_in': upload.expires_in,
+    }
+
+
+@router.put("/storage/{token}", response={201: dict, 400: dict, 404: None}, auth=None, url_name='video_storage', include_in_schema=False)
+def put_stored_video(request, token: str):
+    storage = video_storage()
+    if not isinstance(storage, LocalVideoStorage):
+        return 404, None
+    try:
+        name = storage.receive(token, request)
+    except signing.BadSignature:
+        return 400, {'detail': "Invalid or expired link"}
+    except ValueError as e:
+        return 400, {'detail': str(e)}
+    return 201, {'key': name}
+
+
+@router.get("/storage/{token}", auth=None, include_in_schema=False)
+def get_stored_video(request, token: str):
+    storage = video_storage()
+    if not isinstance(storage, LocalVideoStorage):
+        raise Http404
+    try:
+        name = storage.unsign(token, 'get')['name']
+    except signing.BadSignature:
+        raise Http404
+    if not storage.exists(name):
+        raise Http404
+    # Range support lets players seek without downloading everything
+    return streaming.file_range(
+        storage.open(name), storage.size(name), request.headers.get('Range'))
+
+
+@router.get("/uploads/{uuid:uploadID}", response=schemas.UploadSchema)
+def get_upload(request, uploadID: UUID):
+    return get_object_or_404(
+        models.Upload, pk=uploadID, instructor_id=request.auth['id'])
+
+
+@router.put("/uploads/{uuid:uploadID}", response={200: schemas.UploadSchema, 400: dict, 409: dict})
+def upload_chunk(request, uploadID: UUID, offset: int):
+    get_object_or_404(
+        models.Upload, pk=uploadID, instructor_id=request.auth['id'])
+    try:
+        upload = blobs.write_chunk(
+            uploadID, request.auth['id'], offset, request)
+    except blobs.OffsetMismatch as e:
+        return 409, {'detail': str(e), 'offset': e.offset}
+    except (blobs.ChecksumMismatch, ValueError) as e:
+        return 400, {'detail': str(e)}
+    return 200, upload
+
+
+def _course_lessons(courseID: int):
+    return models.Lesson.objects.filter(
+        course_id=courseID, course__deleted_at__isnull=True
+    ).order_by('number', 'pk')
 
 
 @router.get("/{int:courseID}/lessons", response=list[schemas.LessonSchema], auth=None)
+@paginate
 def get_course_lessons(request, courseID: int):
+    return _course_lessons(courseID)
+
+
+@router.get("/{int:courseID}/lessons/export", auth=None)
+def export_course_lessons(request, courseID: int):
+    return streaming.ndjson(_course_lessons(courseID), schemas.LessonSchema)
+
+
+@router.get("/{int:courseID}/lessons/batch", response=list[schemas.LessonSchemaFull], auth=AuthBearer())
+def get_course_lessons_batch(request, courseID: int, ids: list[int] = Query(None)):
+    get_object_or_404(models.Access, course_id=courseID,
+                      user_id=request.auth['id'],
+                      course__deleted_at__isnull=True)
     objs = models.Lesson.objects.filter(course_id=courseID).order_by('number')
-    return objs
+    if ids:
+        objs = objs.filter(pk__in=ids)
+    return streaming.json_array(objs, schemas.LessonSchemaFull)
 
 
 @router.get("/{int:courseID}/lessons/{int:lessonID}", response=schemas.LessonSchemaFull, auth=AuthBearer())
 def get_course_lesson(request, courseID: int, lessonID: int):
     get_object_or_404(models.Access, course_id=courseID,
-                      user_id=request.auth['id'])
+                      user_id=request.auth['id'],
+                      course__deleted_at__isnull=True)
     obj = get_object_or_404(models.Lesson, pk=lessonID)
     return obj
 
 
-@router.put("/{int:courseID}/lessons/{int:lessonID}", response=schemas.LessonSchemaFull)
-def update_lesson(request, courseID: int, lessonID: int, data: Form[schemas.LessonSchemaIn], video: UploadedFile | None = File(None)):
-    data = data.dict()
-    data['course_id'] = courseID
+def _update_lesson(request, courseID: int, lessonID: int, data: dict, video: UploadedFile | None):
     get_object_or_404(models.Course, pk=courseID,
                       instructor_id=request.auth['id'])
+    blob = _video_blob(
+        request, video,
+        data.pop('video_sha256', None), data.pop('video_key', None))
+
+    obj = get_object_or_404(models.Lesson, pk=lessonID, course_id=courseID)
+
+    with transaction.atomic():
+        if blob and blob.pk != obj.blob_id:
+            blobs.attach(obj, blob)
+            obj.video_status = models.VideoStatus.PENDING
+            _process_video(obj)
+            _save_changes(obj, data, 'video', 'blob', 'video_status')
+        else:
+            # same video as before, nothing to store
+            _save_changes(obj, data)
+    return obj
 
-    obj = get_object_or_404(models.Lesson, pk=lessonID)
 
-    for key, value in data.items():
-        setattr(obj, key, value)
+@router.put("/{int:courseID}/lessons/{int:lessonID}", response={200: schemas.LessonSchemaFull, 400: dict})
+def update_lesson(request, courseID: int, lessonID: int, data: Form[schemas.LessonSchemaIn], video: UploadedFile | None = File(None)):
+    data = data.dict()
+    data['course_id'] = courseID
+    return _update_lesson(request, courseID, lessonID, data, video)
 
-    if video:
-        obj.video.save(video.name, video, save=False)
-    obj.save()
-    return obj
+
+@router.patch("/{int:courseID}/lessons/{int:lessonID}", response={200: schemas.LessonSchemaFull, 400: dict})
+def patch_lesson(request, courseID: int, lessonID: int, data: Form[schemas.LessonSchemaPatch], video: UploadedFile | None = File(None)):
+    return _update_lesson(
+        request, courseID, lessonID, data.dict(exclude_unset=True), video)
 
 
 @router.delete("/{int:courseID}/lessons/{int:lessonID}", response={204: None})
@@ -124,20 +322,37 @@ def delete_lesson(request, courseID: int, lessonID: int):
     return 204, None
 
 
-@router.get("/{int:courseID}/requests", response=list[schemas.RequestSchema], auth=AuthInstructor())
-def get_join_requests(request, courseID: int):
+def _attach_users(requests: list[models.JoinRequest]):
+    if not requests:
+        return requests
+    code, users = api.get_users([r.user_id for r in requests])
+    if code != 200:
+        # users service is down, answer without user data
+        users = []
+    users = {u['id']: u for u in users}
+    for r in requests:
+        r.user = users.get(r.user_id)
+    return requests
+
+
+def _join_requests(request, courseID: int):
     get_object_or_404(models.Course, pk=courseID,
                       instructor_id=request.auth['id'])
-    requests = models.JoinRequest.objects.filter(course_id=courseID)
+    return models.JoinRequest.objects.filter(
+        course_id=courseID).select_related('course').order_by('pk')
 
-    user_ids = [x.user_id for x in requests]
-    code, users = api.get_users(user_ids)
-    for r in requests:
-        for u in users:
-            if r.user_id == u['id']:
-                r.user = u
 
-    return requests
+@router.get("/{int:courseID}/requests", response=list[schemas.RequestSchema], auth=AuthInstructor())
+@paginate(pagination.EnrichedPagination, enrich=_attach_users)
+def get_join_requests(request, courseID: int):
+    return _join_requests(request, courseID)
+
+
+@router.get("/{int:courseID}/requests/export", auth=AuthInstructor())
+def export_join_requests(request, courseID: int):
+    return streaming.ndjson(
+        _join_requests(request, courseID), schemas.RequestSchema,
+        enrich=_attach_users)
 
 
 @router.post("/{int:courseID}/requests", response={200: dict, 201: dict}, auth=AuthBearer())
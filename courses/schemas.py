@@ -1,14 +1,22 @@
 from ninja import Schema, ModelSchema, Field
 from pydantic import ValidationError, field_validator
+from uuid import UUID
 
 from . import models
 
 
+SHA256_PATTERN = r'^[0-9a-f]{64}$'
+
+
 class CourseSchemaIn(Schema):
     name: str
     description: str | None = None
 
 
+class CourseSchemaPatch(CourseSchemaIn):
+    name: str = None
+
+
 class CourseSchema(ModelSchema):
     lesson_count: int = 0
 
@@ -17,6 +25,19 @@ class CourseSchema(ModelSchema):
         fields = ['id', 'name', 'description', 'instructor_id']
 
 
+class CoursePage(Schema):
+    items: list[CourseSchema]
+    count: int
+
+
+class CourseStatsSchema(Schema):
+    id: int
+    name: str
+    student_count: int
+    pending_request_count: int
+    lesson_count: int
+
+
 class CourseSchemaWithCode(CourseSchema):
     code: str
 
@@ -34,6 +55,8 @@ class LessonSchemaIn(Schema):
     content: str
     number: int
     quiz_id: int | None = None
+    video_sha256: str | None = Field(None, pattern=SHA256_PATTERN)
+    video_key: str | None = None
 
     @field_validator('quiz_id', mode='after')
     @classmethod
@@ -44,9 +67,16 @@ class LessonSchemaIn(Schema):
         return value
 
 
+class LessonSchemaPatch(LessonSchemaIn):
+    name: str = None
+    content: str = None
+    number: int = None
+
+
 class LessonSchemaFull(LessonSchema):
     content: str
     video: str | None
+    video_status: str
     quiz_id: int | None
 
 
@@ -71,7 +101,7 @@ class CodeSchema(Schema):
 class RequestSchema(Schema):
     id: int
     course: CourseSchema
-    user: dict
+    user: dict | None = None
 
 
 class RequestAnswer(Schema):
@@ -81,3 +111,37 @@ class RequestAnswer(Schema):
 
 class RequestAnswerSchema(Schema):
     requests: list[RequestAnswer] = []
+
+
+class BreakerSchema(Schema):
+    state: str
+    failures: int
+    retry_in: float
+
+
+class UploadSchemaIn(Schema):
+    name: str = Field(max_length=200)
+    sha256: str = Field(pattern=SHA256_PATTERN)
+    size: int = Field(gt=0)
+
+
+class UploadSchema(Schema):
+    id: UUID
+    name: str
+    sha256: str
+    size: int
+    offset: int
+    complete: bool
+
+    @staticmethod
+    def resolve_complete(obj):
+        return obj.blob_id is not None
+
+
+class PresignSchema(Schema):
+    key: str
+    complete: bool
+    url: str | None = None
+    method: str | None = None
+    headers: dict = {}
+    expires_in: int | None = None
@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import os
+
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, Storage, storages
+from django.urls import reverse
+from django.utils.deconstruct import deconstructible
+
+
+SALT = 'courses.storage'
+# lifetime of presigned URLs, in seconds
+EXPIRES = 60 * 60
+
+
+def video_storage():
+    return storages['videos']
+
+
+class PresignedUpload:
+    def __init__(self, url: str, headers: dict):
+        self.url = url
+        self.method = 'PUT'
+        self.headers = headers
+        self.expires_in = EXPIRES
+
+
+def _checksum_header(sha256: str) -> str:
+    return base64.b64encode(bytes.fromhex(sha256)).decode()
+
+
+@deconstructible
+class LocalVideoStorage(FileSystemStorage):
+    """Stores videos under MEDIA_ROOT.
+
+    Stands in for object storage: presigned URLs are signed links to
+    this service, which checks the checksum of uploaded content itself.
+    """
+
+    def presigned_upload(self, name: str, sha256: str, size: int) -> PresignedUpload:
+        token = signing.dumps(
+            {'op': 'put', 'name': name, 'sha256': sha256, 'size': size},
+            salt=SALT)
+        return PresignedUpload(
+            reverse('api-1.0.0:video_storage', kwargs={'token': token}),
+            {'x-amz-checksum-sha256': _checksum_header(sha256)},
+        )
+
+    def url(self, name):
+        token = signing.dumps({'op': 'get', 'name': name}, salt=SALT)
+        return reverse('api-1.0.0:video_storage', kwargs={'token': token})
+
+    def receive(self, token: str, stream) -> str:
+        """Stores an upload sent to a presigned URL, returns its name."""
+        data = self.unsign(token, 'put')
+        if self.exists(data['name']):
+            return data['name']
+        digest = hashlib.sha256()
+        size = 0
+
+        class Reader(File):
+            def chunks(self, chunk_size=None):
+                nonlocal size
+                while chunk := stream.read(chunk_size or self.DEFAULT_CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    if size > data['size']:
+                        raise ValueError("Upload is bigger than declared")
+                    yield chunk
+
+        name = None
+        try:
+            name = self.save(data['name'], Reader(stream, data['name']))
+            if digest.hexdigest() != data['sha256'] or size != data['size']:
+                raise ValueError("Uploaded content does not match checksum")
+        except Exception:
+            self.delete(name or data['name'])
+            raise
+        return name
+
+    def checksum(self, name: str) -> str | None:
+        """Returns the sha256 of the stored content."""
+        digest = hashlib.sha256()
+        with self.open(name) as f:
+            for chunk in f.chunks():
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def move(self, name: str, target: str) -> str:
+        target = self.get_available_name(target)
+        os.makedirs(os.path.dirname(self.path(target)), exist_ok=True)
+        os.replace(self.path(name), self.path(target))
+        return target
+
+    def unsign(self, token: str, op: str) -> dict:
+        data = signing.loads(token, salt=SALT, max_age=EXPIRES)
+        if data['op'] != op:
+            raise signing.BadSignature("Wrong operation")
+        return data
+
+
+@deconstructible
+class S3VideoStorage(Storage):
+    """Stores videos in an S3 compatible bucket (AWS, MinIO, ...).
+
+    Needs boto3. Downloads and uploads use presigned URLs, so video bytes
+    go between clients and the bucket directly.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: str | None = None,
+                 region: str | None = None, access_key: str | None = None,
+                 secret_key: str | None = None):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                "S3VideoStorage requires the boto3 package") from e
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+            # signs the checksum and length into presigned URLs
+            config=Config(signature_version='s3v4'),
+        )
+
+    def _open(self, name, mode='rb'):
+        body = self.client.get_object(Bucket=self.bucket, Key=name)['Body']
+        return File(body, name)
+
+    def _save(self, name, content):
+        content.seek(0)
+        self.client.upload_fileobj(content, self.bucket, name)
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+        except self.client.exceptions.ClientError:
+            return False
+        return True
+
+    def size(self, name):
+        return self.client.head_object(
+            Bucket=self.bucket, Key=name)['ContentLength']
+
+    def checksum(self, name: str) -> str | None:
+        """Returns the sha256 S3 verified when the object was uploaded."""
+        head = self.client.head_object(
+            Bucket=self.bucket, Key=name, ChecksumMode='ENABLED')
+        checksum = head.get('ChecksumSHA256')
+        if not checksum or '-' in checksum:
+            # uploaded without a checksum, or in parts
+            return None
+        return base64.b64decode(checksum).hex()
+
+    def move(self, name: str, target: str) -> str:
+        self.client.copy(
+            {'Bucket': self.bucket, 'Key': name}, self.bucket, target)
+        self.delete(name)
+        return target
+
+    def url(self, name):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': name},
+            ExpiresIn=EXPIRES)
+
+    def presigned_upload(self, name: str, sha256: str, size: int) -> PresignedUpload:
+        checksum = _checksum_header(sha256)
+        url = self.client.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': self.bucket, 'Key': name,
+                'ContentLength': size, 'ChecksumSHA256': checksum,
+            },
+            ExpiresIn=EXPIRES)
+        # S3 rejects content not matching the checksum header, from_key
+        # still checks the stored object before using it
+        return PresignedUpload(url, {
+            'x-amz-checksum-sha256': checksum,
+            'content-length': str(size),
+        })
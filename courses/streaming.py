@@ -0,0 +1,83 @@
+import mimetypes
+import re
+from itertools import islice
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from ninja import Schema
+
+
+# rows fetched per round trip from the server-side cursor
+CHUNK_SIZE = 200
+# bytes read at once when sending part of a file
+FILE_CHUNK_SIZE = 64 * 1024
+RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+def json_array(qs, schema: type[Schema]) -> StreamingHttpResponse:
+    """Streams the queryset as a JSON array, one row at a time."""
+    def generate():
+        yield b'['
+        for i, obj in enumerate(qs.iterator(chunk_size=CHUNK_SIZE)):
+            if i:
+                yield b','
+            yield schema.from_orm(obj).model_dump_json().encode()
+        yield b']'
+    return StreamingHttpResponse(generate(), content_type='application/json')
+
+
+def ndjson(qs, schema: type[Schema], enrich=None) -> StreamingHttpResponse:
+    """Streams the queryset as newline delimited JSON.
+
+    Rows are read in chunks of `CHUNK_SIZE`, `enrich(chunk)` may add
+    data to each chunk before it is written.
+    """
+    def generate():
+        rows = qs.iterator(chunk_size=CHUNK_SIZE)
+        while chunk := list(islice(rows, CHUNK_SIZE)):
+            if enrich:
+                chunk = enrich(chunk)
+            for obj in chunk:
+                yield schema.from_orm(obj).model_dump_json().encode() + b'\n'
+    return StreamingHttpResponse(
+        generate(), content_type='application/x-ndjson')
+
+
+def file_range(f, size: int, range_header: str | None) -> HttpResponse:
+    """Sends the file, or the single byte range the client asked for."""
+    match = RANGE.fullmatch(range_header or '')
+    if not match or not any(match.groups()):
+        response = FileResponse(f)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # suffix range, the last bytes of the file
+        start, end = max(size - int(last), 0), size - 1
+    if start > end:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    def generate():
+        remaining = end - start + 1
+        with f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+    content_type = mimetypes.guess_type(f.name)[0]
+    response = StreamingHttpResponse(
+        generate(), status=206,
+        content_type=content_type or 'application/octet-stream')
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    return response
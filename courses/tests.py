@@ -1,10 +1,39 @@
-from django.test import TestCase
+import asyncio
+import base64
+from datetime import timedelta
+import hashlib
+import io
+import os
+import sys
+from json import loads as json_loads
+import tempfile
+import threading
+from unittest import mock
+
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from ninja.testing import TestClient
+import requests as http
 
 from courses.router import router
-from courses.api import API
-from courses.models import Course, Lesson, Access, JoinRequest
+from courses.api import (
+    API, UserBatcher, AsyncUserBatcher, CircuitBreaker, RetryBudget
+)
+from courses.models import (
+    Course, Lesson, Access, JoinRequest, Job, VideoBlob, Upload
+)
+from courses import jobs, blobs, catalog
+from courses.storage import video_storage
 from auth import decode_jwt
+from courses.middleware import ProfilingMiddleware
+from main.middleware import PathMiddleware
 
 client = TestClient(router)
 api = API()
@@ -20,6 +49,9 @@ INSTRUCTOR_ID = decode_jwt(INSTRUCTOR_TOKEN)['id']
 
 
 class UserAPITests(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def auth_header(self, token: str):
         return {
             'Authorization': f'Bearer {token}'
@@ -173,6 +205,32 @@ class UserAPITests(TestCase):
         self.assertEqual(response2.status_code, 404)
         self.assertEqual(json['name'], 'First lesson')
 
+    def test_user_can_fetch_many_course_lessons_at_once(self):
+        course = Course.objects.create(
+            name='Has access', description='Bad description', instructor_id=INSTRUCTOR_ID)
+        course2 = Course.objects.create(
+            name='No access', description='Bad description', instructor_id=INSTRUCTOR_ID)
+        lessons = Lesson.objects.bulk_create([
+            Lesson(name=f'Lesson {i}', content='test', number=i, course=course)
+            for i in (3, 1, 2)
+        ])
+        Access.objects.create(user_id=USER_ID, course=course)
+        h = self.auth_header(USER_TOKEN)
+
+        with self.assertNumQueries(2):
+            response = client.get(f"/{course.pk}/lessons/batch", headers=h)
+        response2 = client.get(
+            f"/{course.pk}/lessons/batch?ids={lessons[0].pk}&ids={lessons[1].pk}",
+            headers=h)
+        response3 = client.get(f"/{course2.pk}/lessons/batch", headers=h)
+        json = response.json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([l['number'] for l in json], [1, 2, 3])
+        self.assertEqual(json[0]['content'], 'test')
+        self.assertEqual(len(response2.json()), 2)
+        self.assertEqual(response3.status_code, 404)
+
     def test_instructor_can_edit_lesson_from_his_course(self):
         course = Course.objects.create(
             name='Bad name', description='Bad description', instructor_id=INSTRUCTOR_ID)
@@ -201,6 +259,28 @@ class UserAPITests(TestCase):
         self.assertEqual(json['content'], data['content'])
         self.assertEqual(json['number'], data['number'])
 
+    def test_instructor_can_patch_lesson_from_his_course(self):
+        course = Course.objects.create(
+            name='Bad name', description='Bad description', instructor_id=INSTRUCTOR_ID)
+        l = Lesson.objects.create(
+            name='First lesson', content='Long content', number=1, course=course)
+        url = f"/{course.pk}/lessons/{l.pk}"
+        h = self.auth_header(INSTRUCTOR_TOKEN)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.patch(url, data={"name": "Renamed"}, headers=h)
+        response2 = client.patch(f"/{course.pk}", json={"description": "New"}, headers=h)
+        json = response.json()
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json['name'], 'Renamed')
+        self.assertEqual(json['content'], 'Long content')
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('content', updates[0])
+        self.assertEqual(response2.json()['name'], 'Bad name')
+        self.assertEqual(response2.json()['description'], 'New')
+
     def test_instructor_can_delete_lesson_from_his_course(self):
         course = Course.objects.create(
             name='Bad name', description='Bad description', instructor_id=INSTRUCTOR_ID)
@@ -270,7 +350,40 @@ class UserAPITests(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response2.status_code, 404)
-        self.assertEqual(len(json), 2)
+        self.assertEqual(json['count'], 2)
+        self.assertEqual(json['items'][0]['user']['id'], USER_ID)
+
+    def test_instructor_can_export_join_requests_for_his_course(self):
+        course = Course.objects.create(
+            name='Bad name', description='Bad description', instructor_id=INSTRUCTOR_ID)
+        JoinRequest.objects.bulk_create(
+            [JoinRequest(course=course, user_id=USER_ID + i) for i in range(5)]
+        )
+        h = self.auth_header(INSTRUCTOR_TOKEN)
+
+        response = client.get(f"/{course.pk}/requests/export", headers=h)
+        lines = response.content.decode().splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json_loads(lines[0])['user']['id'], USER_ID)
+
+    def test_guest_can_page_through_course_lessons(self):
+        course = Course.objects.create(
+            name='Long course', description='Test', instructor_id=INSTRUCTOR_ID)
+        Lesson.objects.bulk_create([
+            Lesson(name=f'Lesson {i}', content='Bla', number=i, course=course)
+            for i in range(1, 6)
+        ])
+
+        response = client.get(f"/{course.pk}/lessons?limit=2&offset=2")
+        response2 = client.get(f"/{course.pk}/lessons/export")
+        json = response.json()
+
+        self.assertEqual(json['count'], 5)
+        self.assertEqual([l['number'] for l in json['items']], [3, 4])
+        self.assertEqual(len(response2.content.splitlines()), 5)
 
     def test_instructor_can_accept_join_requests_for_his_course(self):
         course = Course.objects.create(
@@ -308,3 +421,833 @@ class UserAPITests(TestCase):
             len(Access.objects.filter(course_id=course.pk)), 1)
         self.assertEqual(
             len(JoinRequest.objects.filter(course_id=course2.pk)), 2)
+
+
+class UserBatcherTests(TestCase):
+    def fake_fetch(self, calls):
+        def fetch(ids):
+            calls.append(list(ids))
+            return 200, [{'id': i, 'username': f'user{i}'} for i in ids if i < 100]
+        return fetch
+
+    def test_concurrent_lookups_are_merged_into_one_batch(self):
+        calls = []
+        batcher = UserBatcher(self.fake_fetch(calls), window=0.05)
+        results = {}
+
+        def lookup(user_id):
+            results[user_id] = batcher.get(user_id)
+
+        threads = [threading.Thread(target=lookup, args=(i,))
+                   for i in (1, 2, 2, 3, 100)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(calls, [[1, 2, 3, 100]])
+        self.assertEqual(results[2], (200, {'id': 2, 'username': 'user2'}))
+        self.assertEqual(results[100][0], 404)
+
+    def test_many_lookup_skips_duplicates(self):
+        calls = []
+        batcher = UserBatcher(self.fake_fetch(calls))
+
+        status, users = batcher.get_many([3, 1, 3])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(calls, [[1, 3]])
+        self.assertEqual([u['id'] for u in users], [3, 1])
+
+    def test_async_lookups_are_merged_into_one_batch(self):
+        calls = []
+        batcher = AsyncUserBatcher(self.fake_fetch(calls), window=0.05)
+
+        async def run():
+            return await asyncio.gather(
+                batcher.get(1), batcher.get(1), batcher.get(2),
+                batcher.get_many([1, 2]),
+            )
+
+        results = asyncio.run(run())
+
+        self.assertEqual(calls, [[1, 2]])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[3][0], 200)
+
+    def test_cancelled_async_lookup_does_not_block_others(self):
+        calls = []
+        batcher = AsyncUserBatcher(self.fake_fetch(calls), window=0.05)
+
+        async def run():
+            leader = asyncio.create_task(batcher.get(1))
+            follower = asyncio.create_task(batcher.get(1))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await asyncio.wait_for(
+                asyncio.gather(follower, batcher.get(2)), 1)
+
+        results = asyncio.run(run())
+
+        self.assertEqual(results[0], (200, {'id': 1, 'username': 'user1'}))
+        self.assertEqual(results[1][0], 200)
+        self.assertEqual(calls, [[1, 2]])
+
+
+class UsersServiceResilienceTests(TestCase):
+    def make_api(self):
+        fake = API()
+        fake.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        fake.retry_budget = RetryBudget()
+        fake.BACKOFF = 0
+        return fake
+
+    def test_breaker_opens_after_repeated_failures(self):
+        fake = self.make_api()
+
+        with mock.patch('courses.api.requests.request',
+                        side_effect=http.Timeout) as request:
+            fake.get_user(1)
+            fake.get_user(1)
+            status, data = fake.get_user(1)
+
+        self.assertEqual(status, 503)
+        self.assertEqual(fake.breaker.state, CircuitBreaker.OPEN)
+        # two calls with two retries each, the third one failed fast
+        self.assertEqual(request.call_count, 6)
+
+    def test_breaker_closes_after_successful_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_breaker_recovers_after_probe_with_broken_response(self):
+        fake = self.make_api()
+        fake.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        fake.breaker.record_failure()
+
+        with mock.patch('courses.api.requests.request',
+                        side_effect=http.exceptions.ChunkedEncodingError):
+            status, data = fake.get_user(1)
+        with mock.patch('courses.api.requests.request',
+                        side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                fake.get_user(1)
+
+        self.assertEqual(status, 503)
+        self.assertEqual(fake.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(fake.breaker.allow())
+
+    def test_response_that_is_not_json_fails_the_call(self):
+        fake = self.make_api()
+        response = mock.Mock(status_code=200)
+        response.json.side_effect = http.JSONDecodeError(
+            'Expecting value', '<html>', 0)
+        fake.breaker.record_failure()
+
+        with mock.patch('courses.api.requests.request',
+                        return_value=response) as request:
+            status, data = fake.get_user(1)
+
+        self.assertEqual(status, 503)
+        self.assertEqual(request.call_count, 3)
+        # never counted as a success in between
+        self.assertEqual(fake.breaker.state, CircuitBreaker.OPEN)
+
+    def test_retries_stop_when_budget_is_spent(self):
+        fake = self.make_api()
+        fake.retry_budget = RetryBudget(ratio=0, cap=1)
+
+        with mock.patch('courses.api.requests.request',
+                        side_effect=http.ConnectionError) as request:
+            fake.get_user(1)
+
+        self.assertEqual(request.call_count, 2)
+
+    def test_guest_can_read_users_service_health(self):
+        response = client.get("/health/users")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(response.json()['state'],
+                      ['closed', 'open', 'half_open'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class LessonVideoJobTests(TestCase):
+    def test_uploaded_video_is_processed_in_background(self):
+        course = Course.objects.create(
+            name='Course', description='Test', instructor_id=INSTRUCTOR_ID)
+        content = b'not really a video'
+        data = {"name": "Lesson", "content": "Text", "number": 1}
+        h = {'Authorization': f'Bearer {INSTRUCTOR_TOKEN}'}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                f"/{course.pk}/lessons", data=data, headers=h,
+                FILES={'video': SimpleUploadedFile('intro.mp4', content)}
+            )
+        json = response.json()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json['video_status'], 'pending')
+
+        claimed = jobs.claim('test-worker', 10)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(
+            Job.objects.get(name='process_lesson_video').status,
+            Job.Status.RUNNING)
+        jobs.run_job(claimed[0])
+
+        lesson = Lesson.objects.get(pk=json['id'])
+        self.assertEqual(
+            Job.objects.get(name='process_lesson_video').status,
+            Job.Status.DONE)
+        self.assertEqual(lesson.video_status, 'ready')
+        self.assertEqual(lesson.video_size, len(content))
+        self.assertEqual(lesson.video_checksum,
+                         hashlib.sha256(content).hexdigest())
+
+    def test_failing_job_is_retried_then_marked_failed(self):
+        calls = []
+
+        @jobs.job('always_fails')
+        def always_fails(**payload):
+            calls.append(payload)
+            raise RuntimeError('boom')
+
+        self.addCleanup(jobs.REGISTRY.pop, 'always_fails')
+        obj = Job.objects.create(name='always_fails', max_attempts=2)
+
+        jobs.run_job(obj)
+        self.assertEqual(obj.status, Job.Status.PENDING)
+        self.assertGreater(obj.run_at, obj.created_at)
+        jobs.run_job(obj)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, Job.Status.FAILED)
+        self.assertIn('boom', obj.last_error)
+        self.assertEqual(len(calls), 2)
+
+    def test_claim_respects_job_concurrency(self):
+        jobs.job('one_at_a_time', concurrency=1)(lambda: None)
+        jobs.job('any_number')(lambda: None)
+        self.addCleanup(jobs.REGISTRY.pop, 'one_at_a_time')
+        self.addCleanup(jobs.REGISTRY.pop, 'any_number')
+        Job.objects.bulk_create(
+            [Job(name='one_at_a_time') for _ in range(3)]
+            + [Job(name='any_number')])
+
+        claimed = jobs.claim('test-worker', 3)
+        claimed_again = jobs.claim('test-worker', 3)
+
+        self.assertEqual(sorted(j.name for j in claimed),
+                         ['any_number', 'one_at_a_time'])
+        self.assertEqual(claimed_again, [])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class VideoBlobTests(TestCase):
+    content = b'0123456789' * 100
+
+    def setUp(self):
+        self.course = Course.objects.create(
+            name='Course', description='Test', instructor_id=INSTRUCTOR_ID)
+        self.h = {'Authorization': f'Bearer {INSTRUCTOR_TOKEN}'}
+        self.sha = hashlib.sha256(self.content).hexdigest()
+
+    def create_lesson(self, **kwargs):
+        data = {"name": "Lesson", "content": "Text", "number": 1}
+        data.update(kwargs.pop('data', {}))
+        return client.post(f"/{self.course.pk}/lessons", data=data,
+                           headers=self.h, **kwargs)
+
+    def test_interrupted_upload_can_be_resumed(self):
+        data = {'name': 'intro.mp4', 'sha256': self.sha,
+                'size': len(self.content)}
+
+        response = client.post("/uploads", json=data, headers=self.h)
+        upload_id = response.json()['id']
+        blobs.write_chunk(upload_id, INSTRUCTOR_ID, 0,
+                          io.BytesIO(self.content[:400]))
+        response2 = client.post("/uploads", json=data, headers=self.h)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response2.status_code, 200)
+        self.assertEqual(response2.json()['id'], upload_id)
+        self.assertEqual(response2.json()['offset'], 400)
+        with self.assertRaises(blobs.OffsetMismatch):
+            blobs.write_chunk(upload_id, INSTRUCTOR_ID, 0,
+                              io.BytesIO(self.content))
+
+        upload = blobs.write_chunk(upload_id, INSTRUCTOR_ID, 400,
+                                   io.BytesIO(self.content[400:]))
+
+        self.assertEqual(upload.blob.sha256, self.sha)
+        with upload.blob.file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_upload_resumes_where_part_file_ends(self):
+        upload, _ = blobs.start_upload(
+            INSTRUCTOR_ID, self.sha, len(self.content), 'intro.mp4')
+        blobs.write_chunk(upload.pk, INSTRUCTOR_ID, 0,
+                          io.BytesIO(self.content[:400]))
+        blobs.part_path(upload).unlink()
+
+        with self.assertRaises(blobs.OffsetMismatch) as error:
+            blobs.write_chunk(upload.pk, INSTRUCTOR_ID, 400,
+                              io.BytesIO(self.content[400:]))
+
+        self.assertEqual(error.exception.offset, 0)
+        upload.refresh_from_db()
+        self.assertEqual(upload.offset, 0)
+
+    def test_unused_blob_is_purged_later(self):
+        upload, _ = blobs.start_upload(
+            INSTRUCTOR_ID, self.sha, len(self.content), 'intro.mp4')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            upload = blobs.write_chunk(upload.pk, INSTRUCTOR_ID, 0,
+                                       io.BytesIO(self.content))
+        purge = Job.objects.get(name='purge_blob')
+
+        self.assertGreater(purge.run_at - purge.created_at,
+                           blobs.UNUSED_BLOB_TTL - timedelta(minutes=1))
+        self.assertEqual(jobs.claim('test-worker', 10), [])
+        jobs.run_job(purge)
+        self.assertFalse(VideoBlob.objects.exists())
+        self.assertFalse(video_storage().exists(upload.blob.file.name))
+
+    def test_abandoned_upload_is_purged(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            upload, _ = blobs.start_upload(
+                INSTRUCTOR_ID, self.sha, len(self.content), 'intro.mp4')
+        blobs.write_chunk(upload.pk, INSTRUCTOR_ID, 0,
+                          io.BytesIO(self.content[:400]))
+        purge = Job.objects.get(name='purge_upload')
+
+        # continued since, so it is checked again later
+        with self.captureOnCommitCallbacks(execute=True):
+            jobs.run_job(purge)
+        self.assertTrue(blobs.part_path(upload).exists())
+        Upload.objects.filter(pk=upload.pk).update(
+            updated_at=timezone.now() - blobs.UPLOAD_TTL)
+        jobs.run_job(Job.objects.get(name='purge_upload',
+                                     status=Job.Status.PENDING))
+
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(blobs.part_path(upload).exists())
+
+    def test_corrupted_upload_starts_over(self):
+        upload, _ = blobs.start_upload(
+            INSTRUCTOR_ID, self.sha, len(self.content), 'intro.mp4')
+
+        with self.assertRaises(blobs.ChecksumMismatch):
+            blobs.write_chunk(upload.pk, INSTRUCTOR_ID, 0,
+                              io.BytesIO(b'x' * len(self.content)))
+
+        upload.refresh_from_db()
+        self.assertEqual(upload.offset, 0)
+        self.assertFalse(VideoBlob.objects.exists())
+
+    def test_duplicate_upload_completes_instantly(self):
+        self.create_lesson(
+            FILES={'video': SimpleUploadedFile('a.mp4', self.content)})
+        data = {'name': 'b.mp4', 'sha256': self.sha,
+                'size': len(self.content)}
+
+        response = client.post("/uploads", json=data, headers=self.h)
+        response2 = self.create_lesson(data={'video_sha256': self.sha})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()['complete'])
+        self.assertEqual(response2.status_code, 201)
+        blob = VideoBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(
+            Lesson.objects.get(pk=response2.json()['id']).video.name,
+            blob.file.name)
+
+    def test_stored_video_cannot_be_claimed_by_checksum(self):
+        other = Course.objects.create(
+            name='Paid', description='Test', instructor_id=INSTRUCTOR_ID + 1)
+        blob = blobs.store(SimpleUploadedFile('a.mp4', self.content))
+        Lesson.objects.create(name='Paid lesson', content='Bla', course=other,
+                              blob=blob, video=blob.file.name)
+        data = {'name': 'b.mp4', 'sha256': self.sha,
+                'size': len(self.content)}
+
+        response = self.create_lesson(data={'video_sha256': self.sha})
+        response2 = self.create_lesson(data={'video_key': blob.file.name})
+        response3 = client.post("/uploads/presign", json=data, headers=self.h)
+        response4 = client.post("/uploads", json=data, headers=self.h)
+        # uploading the content proves having it
+        blobs.write_chunk(response4.json()['id'], INSTRUCTOR_ID, 0,
+                          io.BytesIO(self.content))
+        response5 = self.create_lesson(data={'video_sha256': self.sha})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response2.status_code, 400)
+        self.assertFalse(response3.json()['complete'])
+        self.assertFalse(response4.json()['complete'])
+        self.assertEqual(response5.status_code, 201)
+        self.assertEqual(VideoBlob.objects.get(), blob)
+
+    def test_patching_same_video_writes_nothing(self):
+        response = self.create_lesson(
+            FILES={'video': SimpleUploadedFile('a.mp4', self.content)})
+        lesson = Lesson.objects.get()
+        Lesson.objects.filter(pk=lesson.pk).update(video_status='ready')
+        url = f"/{self.course.pk}/lessons/{lesson.pk}"
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.patch(
+                url, headers=self.h,
+                FILES={'video': SimpleUploadedFile('b.mp4', self.content)})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['video_status'], 'ready')
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE')])
+        self.assertEqual(VideoBlob.objects.get().ref_count, 1)
+
+    def test_video_can_be_uploaded_straight_to_storage(self):
+        content = b'uploaded straight to storage'
+        data = {'name': 'intro.mp4',
+                'sha256': hashlib.sha256(content).hexdigest(),
+                'size': len(content)}
+
+        response = client.post("/uploads/presign", json=data, headers=self.h)
+        presigned = response.json()
+        token = presigned['url'].rstrip('/').rsplit('/', 1)[1]
+        storage = video_storage()
+        with self.assertRaises(ValueError):
+            storage.receive(token, io.BytesIO(b'x' * len(content)))
+        storage.receive(token, io.BytesIO(content))
+        response2 = self.create_lesson(data={'video_key': presigned['key']})
+        response3 = client.post("/uploads/presign", json=data, headers=self.h)
+        download = client.get(response2.json()['video'])
+        part = client.get(response2.json()['video'],
+                          headers={'Range': 'bytes=9-15'})
+        response4 = self.create_lesson(data={'video_key': 'videos/nope'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(presigned['complete'])
+        self.assertEqual(presigned['method'], 'PUT')
+        self.assertEqual(response2.status_code, 201)
+        self.assertTrue(response3.json()['complete'])
+        self.assertEqual(response3.json()['key'],
+                         VideoBlob.objects.get().file.name)
+        self.assertEqual(download.content, content)
+        self.assertEqual(part.status_code, 206)
+        self.assertEqual(part['Content-Range'], f'bytes 9-15/{len(content)}')
+        self.assertEqual(part.content, content[9:16])
+        self.assertEqual(response4.status_code, 400)
+        self.assertEqual(VideoBlob.objects.get().ref_count, 1)
+
+    def test_blob_is_purged_when_last_lesson_is_deleted(self):
+        for name in ('a.mp4', 'b.mp4'):
+            self.create_lesson(
+                FILES={'video': SimpleUploadedFile(name, self.content)})
+        first, second = Lesson.objects.all()
+        blob = VideoBlob.objects.get()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(Job.objects.filter(name='purge_blob').exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        jobs.run_job(Job.objects.get(name='purge_blob'))
+
+        self.assertFalse(VideoBlob.objects.exists())
+        self.assertFalse(blob.file.storage.exists(blob.file.name))
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 S3 client."""
+
+    class exceptions:
+        class ClientError(Exception):
+            pass
+
+    def __init__(self):
+        # key -> (content, checksum S3 verified on upload)
+        self.objects = {}
+        self.presigned = []
+
+    def put(self, url, content, headers):
+        key = url.split('?')[0].split('/', 3)[3]
+        self.objects[key] = (content, headers.get('x-amz-checksum-sha256'))
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        self.presigned.append((method, Params))
+        return f"https://s3.test/{Params['Key']}?X-Amz-Signature=x"
+
+    def head_object(self, Bucket, Key, ChecksumMode=None):
+        if Key not in self.objects:
+            raise self.exceptions.ClientError(Key)
+        content, checksum = self.objects[Key]
+        head = {'ContentLength': len(content)}
+        if ChecksumMode == 'ENABLED' and checksum:
+            head['ChecksumSHA256'] = checksum
+        return head
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key][0])}
+
+    def upload_fileobj(self, f, bucket, key):
+        self.objects[key] = (f.read(), None)
+
+    def copy(self, source, bucket, key):
+        self.objects[key] = self.objects[source['Key']]
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
+class S3VideoStorageTests(TestCase):
+    content = b'stored in a bucket'
+
+    def setUp(self):
+        self.s3 = FakeS3()
+        boto3 = mock.Mock(client=mock.Mock(return_value=self.s3))
+        patcher = mock.patch.dict(sys.modules, {
+            'boto3': boto3, 'botocore': mock.Mock(),
+            'botocore.config': mock.Mock(),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # per test, so that every test gets a storage with its own client
+        storage = override_settings(STORAGES={
+            'default': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'videos': {'BACKEND': 'courses.storage.S3VideoStorage',
+                       'OPTIONS': {'bucket': 'videos'}},
+        })
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.course = Course.objects.create(
+            name='Course', description='Test', instructor_id=INSTRUCTOR_ID)
+        self.h = {'Authorization': f'Bearer {INSTRUCTOR_TOKEN}'}
+        self.data = {'name': 'intro.mp4', 'size': len(self.content),
+                     'sha256': hashlib.sha256(self.content).hexdigest()}
+
+    def create_lesson(self, key):
+        return client.post(
+            f"/{self.course.pk}/lessons", headers=self.h,
+            data={"name": "Lesson", "content": "Text", "number": 1,
+                  "video_key": key})
+
+    def test_presigned_upload_becomes_blob_once_checked(self):
+        presigned = client.post(
+            "/uploads/presign", json=self.data, headers=self.h).json()
+        self.s3.put(presigned['url'], self.content, presigned['headers'])
+
+        response = self.create_lesson(presigned['key'])
+
+        self.assertEqual(response.status_code, 201)
+        method, params = self.s3.presigned[0]
+        self.assertEqual(method, 'put_object')
+        self.assertEqual(params['ContentLength'], len(self.content))
+        self.assertEqual(
+            params['ChecksumSHA256'],
+            base64.b64encode(hashlib.sha256(self.content).digest()).decode())
+        blob = VideoBlob.objects.get()
+        self.assertEqual(list(self.s3.objects), [blob.file.name])
+        self.assertEqual(video_storage().url(blob.file.name),
+                         f"https://s3.test/{blob.file.name}?X-Amz-Signature=x")
+
+    def test_upload_without_verified_checksum_is_rejected(self):
+        presigned = client.post(
+            "/uploads/presign", json=self.data, headers=self.h).json()
+        # bytes of some other video, sent without the checksum header
+        self.s3.put(presigned['url'], b'x' * len(self.content), {})
+
+        response = self.create_lesson(presigned['key'])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(VideoBlob.objects.exists())
+        self.assertEqual(self.s3.objects, {})
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CourseCloneTests(TestCase):
+    def auth_header(self, token: str):
+        return {'Authorization': f'Bearer {token}'}
+
+    def test_instructor_can_clone_his_course(self):
+        course = Course.objects.create(
+            name='Term 1', description='Test', instructor_id=INSTRUCTOR_ID)
+        blob = VideoBlob.objects.create(
+            sha256='a' * 64, size=1, file='videos/aa/intro.mp4', ref_count=2)
+        Lesson.objects.bulk_create([
+            Lesson(name=f'Lesson {i}', content='Bla', number=i,
+                   course=course, blob=blob, video=blob.file.name)
+            for i in (1, 2)
+        ] + [Lesson(name='Lesson 3', content='Bla', number=3, course=course)])
+        url = f"/{course.pk}/clone?name=Term%202"
+
+        with self.assertNumQueries(7):
+            response = client.post(
+                url, headers=self.auth_header(INSTRUCTOR_TOKEN))
+        response2 = client.post(url, headers=self.auth_header(USER_TOKEN))
+        json = response.json()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response2.status_code, 401)
+        self.assertEqual(json['name'], 'Term 2')
+        self.assertEqual(json['lesson_count'], 3)
+        self.assertNotEqual(json['code'], course.code)
+        clone = Lesson.objects.filter(course_id=json['id'])
+        self.assertEqual(
+            [l.name for l in clone], ['Lesson 1', 'Lesson 2', 'Lesson 3'])
+        self.assertEqual(clone[0].video.name, blob.file.name)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 4)
+
+    def test_clone_of_pending_video_gets_processed(self):
+        course = Course.objects.create(
+            name='Term 1', description='Test', instructor_id=INSTRUCTOR_ID)
+        content = b'still processing'
+        h = self.auth_header(INSTRUCTOR_TOKEN)
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(
+                f"/{course.pk}/lessons",
+                data={"name": "Lesson", "content": "Text", "number": 1},
+                headers=h,
+                FILES={'video': SimpleUploadedFile('intro.mp4', content)}
+            )
+
+        clone = course.clone()
+        self.assertEqual(Lesson.objects.get(course=clone).video_status,
+                         'pending')
+        for obj in jobs.claim('test-worker', 10):
+            jobs.run_job(obj)
+
+        lesson = Lesson.objects.get(course=clone)
+        self.assertEqual(lesson.video_status, 'ready')
+        self.assertEqual(lesson.video_checksum,
+                         hashlib.sha256(content).hexdigest())
+
+    def test_clone_is_processed_after_source_is_deleted(self):
+        course = Course.objects.create(
+            name='Term 1', description='Test', instructor_id=INSTRUCTOR_ID)
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(
+                f"/{course.pk}/lessons",
+                data={"name": "Lesson", "content": "Text", "number": 1},
+                headers=self.auth_header(INSTRUCTOR_TOKEN),
+                FILES={'video': SimpleUploadedFile('intro.mp4', b'old term')}
+            )
+
+        clone = course.clone()
+        course.delete()
+        for obj in jobs.claim('test-worker', 10):
+            jobs.run_job(obj)
+
+        self.assertEqual(
+            Lesson.objects.get(course=clone).video_status, 'ready')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CoursePurgeTests(TestCase):
+    def test_deleted_course_is_purged_in_batches(self):
+        course = Course.objects.create(
+            name='Big course', description='Test', instructor_id=INSTRUCTOR_ID)
+        blob = VideoBlob.objects.create(
+            sha256='b' * 64, size=1, file='videos/bb/b.mp4', ref_count=3)
+        legacy = default_storage.save('old.mp4', ContentFile(b'old'))
+        Lesson.objects.bulk_create(
+            [Lesson(name=f'Lesson {i}', content='Bla', course=course,
+                    blob=blob, video=blob.file.name) for i in range(3)]
+            + [Lesson(name='Old', content='Bla', course=course, video=legacy)]
+        )
+        Access.objects.bulk_create(
+            [Access(course=course, user_id=i) for i in range(1, 6)])
+        JoinRequest.objects.bulk_create(
+            [JoinRequest(course=course, user_id=i) for i in range(6, 9)])
+        h = {'Authorization': f'Bearer {INSTRUCTOR_TOKEN}'}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.delete(f"/{course.pk}", headers=h)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Course.objects.filter(pk=course.pk).exists())
+        self.assertTrue(Course.all_objects.filter(pk=course.pk).exists())
+
+        with mock.patch.object(jobs, 'PURGE_BATCH', 2), \
+                self.captureOnCommitCallbacks(execute=True):
+            jobs.run_job(Job.objects.get(name='purge_course'))
+
+        self.assertFalse(Course.all_objects.filter(pk=course.pk).exists())
+        self.assertFalse(Lesson.objects.exists())
+        self.assertFalse(Access.objects.exists())
+        self.assertFalse(JoinRequest.objects.exists())
+        self.assertFalse(default_storage.exists(legacy))
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertTrue(Job.objects.filter(name='purge_blob').exists())
+
+
+class PathMiddlewareTests(TestCase):
+    def test_only_admin_paths_get_sessions_and_auth(self):
+        seen = {}
+
+        def view(request):
+            seen[request.path] = hasattr(request, 'session')
+            return HttpResponse()
+
+        middleware = PathMiddleware(view)
+        factory = RequestFactory()
+
+        middleware(factory.get('/admin/login/'))
+        middleware(factory.get('/health/users'))
+
+        self.assertTrue(seen['/admin/login/'])
+        self.assertFalse(seen['/health/users'])
+
+
+class ProfilingMiddlewareTests(TestCase):
+    @override_settings(PROFILING_TOKEN='secret', PROFILING_SAMPLE_RATE=0)
+    def test_request_with_token_is_profiled(self):
+        def view(request):
+            Course.objects.count()
+            return HttpResponse()
+
+        factory = RequestFactory()
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PROFILING_DIR=directory):
+            middleware = ProfilingMiddleware(view)
+            response = middleware(
+                factory.get('/1/lessons', headers={'X-Profile': 'secret'}))
+            response2 = middleware(
+                factory.get('/1/lessons', headers={'X-Profile': 'guess'}))
+            name = response['X-Profile-Id']
+            with open(f"{directory}/{name}.json") as f:
+                timeline = json_loads(f.read())
+            files = sorted(os.listdir(directory))
+
+        self.assertFalse(response2.has_header('X-Profile-Id'))
+        self.assertEqual(files, [f'{name}.json', f'{name}.prof'])
+        self.assertEqual(timeline['path'], '/1/lessons')
+        self.assertEqual(len(timeline['queries']), 1)
+
+    @override_settings(PROFILING_TOKEN=None, PROFILING_SAMPLE_RATE=1,
+                       PROFILING_MAX_DUMPS=2)
+    def test_only_latest_dumps_are_kept(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PROFILING_DIR=directory):
+            middleware = ProfilingMiddleware(lambda request: HttpResponse())
+            names = [middleware(RequestFactory().get('/'))['X-Profile-Id']
+                     for _ in range(3)]
+            files = sorted(os.listdir(directory))
+
+        self.assertEqual(files, sorted(
+            f'{name}.{ext}' for name in names[1:] for ext in ('json', 'prof')))
+
+    @override_settings(PROFILING_TOKEN='secret', PROFILING_SAMPLE_RATE=0)
+    def test_streamed_response_is_profiled_until_consumed(self):
+        def view(request):
+            def generate():
+                yield b'['
+                yield str(Course.objects.count()).encode()
+                yield b']'
+            return StreamingHttpResponse(generate())
+
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PROFILING_DIR=directory):
+            response = ProfilingMiddleware(view)(RequestFactory().get(
+                '/1/lessons/export', headers={'X-Profile': 'secret'}))
+            files = os.listdir(directory)
+            content = b''.join(response.streaming_content)
+            with open(f"{directory}/{response['X-Profile-Id']}.json") as f:
+                timeline = json_loads(f.read())
+
+        self.assertEqual(files, [])
+        self.assertEqual(content, b'[0]')
+        self.assertTrue(timeline['streamed'])
+        self.assertEqual(len(timeline['queries']), 1)
+
+
+class CatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_catalog_is_served_from_snapshot_and_updated_on_change(self):
+        course = Course.objects.create(
+            name='First course', description='Test', instructor_id=INSTRUCTOR_ID)
+        h = {'Authorization': f'Bearer {INSTRUCTOR_TOKEN}'}
+
+        client.get("")
+        with self.assertNumQueries(0):
+            response = client.get("")
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f"/{course.pk}/lessons", headers=h,
+                        data={"name": "Lesson", "content": "Bla", "number": 1})
+            client.post("", json={"name": "Second course"}, headers=h)
+        response2 = client.get("?limit=1")
+        response3 = client.get("", headers={'If-None-Match': response2['ETag']})
+        json = response2.json()
+
+        self.assertEqual(response.json()['count'], 1)
+        self.assertIn('max-age', response['Cache-Control'])
+        self.assertNotEqual(response['ETag'], response2['ETag'])
+        self.assertEqual(json['count'], 2)
+        self.assertEqual(json['items'][0]['lesson_count'], 1)
+        self.assertEqual(response3.status_code, 304)
+
+    def test_concurrent_refreshes_do_not_lose_courses(self):
+        Course.objects.create(
+            name='First course', description='Test', instructor_id=INSTRUCTOR_ID)
+        catalog.page(10, 0)
+        stale = cache.get('catalog:ids')
+        get = cache.get
+        new = [
+            Course.objects.create(
+                name=name, description='Test', instructor_id=INSTRUCTOR_ID)
+            for name in ('Second course', 'Third course')
+        ]
+
+        # both refreshes read the index before either of them is done
+        with mock.patch.object(
+                caches['default'], 'get',
+                lambda key, default=None: stale if key == 'catalog:ids'
+                else get(key, default)):
+            for course in new:
+                catalog.refresh(course.pk)
+        content, _ = catalog.page(10, 0)
+
+        self.assertEqual(json_loads(content)['count'], 3)
+
+
+class InstructorStatsTests(TestCase):
+    def test_instructor_gets_stats_of_all_his_courses_in_one_query(self):
+        courses = Course.objects.bulk_create([
+            Course(name=f'Course {i}', instructor_id=INSTRUCTOR_ID)
+            for i in range(3)
+        ] + [Course(name='Not mine', instructor_id=INSTRUCTOR_ID + 1)])
+        Access.objects.bulk_create(
+            [Access(course=courses[0], user_id=i) for i in range(1, 4)])
+        JoinRequest.objects.bulk_create(
+            [JoinRequest(course=courses[0], user_id=9),
+             JoinRequest(course=courses[1], user_id=9)])
+        Lesson.objects.bulk_create(
+            [Lesson(name='L', content='Bla', course=courses[1]) for _ in range(2)])
+        h = {'Authorization': f'Bearer {INSTRUCTOR_TOKEN}'}
+
+        with self.assertNumQueries(1):
+            response = client.get("/stats", headers=h)
+        response2 = client.get(
+            "/stats", headers={'Authorization': f'Bearer {USER_TOKEN}'})
+        json = response.json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response2.status_code, 401)
+        self.assertEqual(len(json), 3)
+        self.assertEqual(
+            [(c['student_count'], c['pending_request_count'], c['lesson_count'])
+             for c in json],
+            [(3, 1, 0), (0, 1, 2), (0, 0, 0)])
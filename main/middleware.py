@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.utils.module_loading import import_string
+
+
+class _Stack:
+    def __init__(self, paths: list[str], get_response):
+        self.view = []
+        self.template_response = []
+        self.exception = []
+
+        handler = get_response
+        for path in reversed(paths):
+            try:
+                middleware = import_string(path)(handler)
+            except MiddlewareNotUsed:
+                continue
+            if hasattr(middleware, 'process_view'):
+                self.view.insert(0, middleware.process_view)
+            if hasattr(middleware, 'process_template_response'):
+                self.template_response.append(
+                    middleware.process_template_response)
+            if hasattr(middleware, 'process_exception'):
+                self.exception.append(middleware.process_exception)
+            handler = convert_exception_to_response(middleware)
+        self.handler = handler
+
+
+class PathMiddleware:
+    """Picks the middleware stack by request path.
+
+    Paths starting with one of `FULL_MIDDLEWARE_PATHS` (the admin) go
+    through `FULL_MIDDLEWARE`, everything else, i.e. the bearer token
+    authenticated API, through the shorter `API_MIDDLEWARE`.
+    """
+
+    def __init__(self, get_response):
+        self.prefixes = tuple(settings.FULL_MIDDLEWARE_PATHS)
+        self.full = _Stack(settings.FULL_MIDDLEWARE, get_response)
+        self.lean = _Stack(settings.API_MIDDLEWARE, get_response)
+
+    def __call__(self, request):
+        if request.path_info.startswith(self.prefixes):
+            request._middleware_stack = self.full
+        else:
+            request._middleware_stack = self.lean
+        return request._middleware_stack.handler(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        for method in request._middleware_stack.view:
+            response = method(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+
+    def process_template_response(self, request, response):
+        for method in request._middleware_stack.template_response:
+            response = method(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        for method in request._middleware_stack.exception:
+            response = method(request, exception)
+            if response is not None:
+                return response
+
@@ -23,6 +23,18 @@ DATABASES = {
         'PORT': os.environ.get('POSTGRES_PORT'),
     }
 }
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+# cache holding the serialized public course list. Changes are applied
+# by the process that made them, so running more than one process needs
+# a shared backend (CACHE_BACKEND=...RedisCache or ...PyMemcacheCache),
+# with the default per-process LocMemCache the others serve stale lists
+CATALOG_CACHE = 'default'
 INSTALLED_APPS = [
     'courses',
     'django.contrib.admin',
@@ -32,7 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 ]
-MIDDLEWARE = [
+FULL_MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -40,8 +52,23 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'ninja.compatibility.files.fix_request_files_middleware'
 ]
+# API routes authenticate with bearer tokens only, so sessions, CSRF,
+# auth and messages are needed just for the admin
+API_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+FULL_MIDDLEWARE_PATHS = ['/admin/']
+LEAN_API_MIDDLEWARE = os.environ.get('LEAN_API_MIDDLEWARE', '1') == '1'
+if LEAN_API_MIDDLEWARE:
+    MIDDLEWARE = ['main.middleware.PathMiddleware']
+    # the admin still gets these through FULL_MIDDLEWARE
+    SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+else:
+    MIDDLEWARE = FULL_MIDDLEWARE.copy()
+MIDDLEWARE.insert(0, 'courses.middleware.ProfilingMiddleware')
+MIDDLEWARE.append('ninja.compatibility.files.fix_request_files_middleware')
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -78,3 +105,41 @@ USE_TZ = True
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 STATIC_ROOT = BASE_DIR / 'static'
 MEDIA_ROOT = BASE_DIR / 'tmp'
+# Chunked uploads (/uploads) stage their parts here, on the disk
+# of the replica that got the chunk. With several replicas this has to be
+# a volume all of them mount, or chunked uploads need sticky routing;
+# /uploads/presign uploads go straight to the video storage.
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR')
+# Lesson videos are kept in the "videos" storage. Set
+# VIDEO_STORAGE_BUCKET to keep them in S3 compatible object storage
+# (e.g. MinIO at VIDEO_STORAGE_ENDPOINT) instead of MEDIA_ROOT.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'videos': {
+        'BACKEND': 'courses.storage.LocalVideoStorage',
+    },
+}
+if os.environ.get('VIDEO_STORAGE_BUCKET'):
+    STORAGES['videos'] = {
+        'BACKEND': 'courses.storage.S3VideoStorage',
+        'OPTIONS': {
+            'bucket': os.environ.get('VIDEO_STORAGE_BUCKET'),
+            'endpoint_url': os.environ.get('VIDEO_STORAGE_ENDPOINT'),
+            'region': os.environ.get('VIDEO_STORAGE_REGION'),
+            'access_key': os.environ.get('VIDEO_STORAGE_ACCESS_KEY'),
+            'secret_key': os.environ.get('VIDEO_STORAGE_SECRET_KEY'),
+        },
+    }
+
+# Requests sent with "X-Profile: <PROFILING_TOKEN>" are always profiled,
+# others with PROFILING_SAMPLE_RATE probability
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+PROFILING_DIR = BASE_DIR / 'profiles'
+# dumps of older requests are deleted, 0 keeps them all
+PROFILING_MAX_DUMPS = int(os.environ.get('PROFILING_MAX_DUMPS', 1000))